@@ -1,129 +1,398 @@
 # mvp/agents.py
 
-import json
+import re
+import string
+import hashlib
+from typing import Literal
+from pydantic import BaseModel, ConfigDict, ValidationError
 import config
+import nli
+import runtime
 import utils
 
-# --- Prompt 模板 ---
+# --- 结构化输出 Schema ---
+# 通过 Structured Outputs (严格JSON Schema) 约束模型输出，保证首次调用即可解析
 
-HYPOTHESIZER_PROMPT = """
-你是一个知识图谱构建专家。请根据以下问题，仅利用你的内部知识，生成一个回答该问题所需要的“假设性知识图谱”。
-这个图谱应该能逻辑清晰地推导出问题的答案。
+class Triple(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    subject: str
+    relation: str
+    object: str
 
-图谱应以JSON格式的三元组（主体, 关系, 客体）的列表形式输出，并包含在一个名为 "triples" 的键中。
+class HypothesisGraph(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    triples: list[Triple]
 
-问题: "{question}"
+class SearchQueries(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    queries: list[str]
 
-请直接输出JSON格式的对象。
-"""
+class TripleVerdict(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    i: int
+    verdict: Literal["Supports", "Refutes", "Neutral"]
 
-QUERY_GENERATOR_PROMPT = """
-你是一位专业的搜索引擎用户。你的首要任务是为一个给定的知识三元组生成有效的Google搜索查询，以便对其进行验证。
-请生成最多3个多样化且简洁的查询。
+class BatchVerdicts(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    decisions: list[TripleVerdict]
 
-知识三元组: {triple}
+class JudgeVerdict(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    decision: Literal["Correct", "Incorrect"]
+    reasoning: str
+
+# --- Prompt 模板 ---
+# 每个智能体的提示拆分为静态的 *_SYSTEM_PROMPT (通过system角色发送) 和只包含动态字段的
+# *_USER_PROMPT。静态前缀在所有调用间完全一致，可被服务商的前缀缓存复用。
 
-你的最终输出必须是一个JSON对象，其中包含一个名为 "queries" 的键，其值为一个字符串列表。
-示例: {{"queries": ["维多利亚女王何时与阿尔伯特亲王结婚", "维多利亚女王 阿尔伯特亲王 婚礼日期"]}}
+HYPOTHESIZER_SYSTEM_PROMPT = """
+你是一个知识图谱构建专家。请根据用户给出的问题，仅利用你的内部知识，生成一个回答该问题所需要的“假设性知识图谱”。
+这个图谱由（主体, 关系, 客体）三元组组成，应该能逻辑清晰地推导出问题的答案。
 """
 
-VERIFIER_PROMPT = """
+HYPOTHESIZER_USER_PROMPT = '问题: "{question}"'
+
+QUERY_GENERATOR_SYSTEM_PROMPT = """
+你是一位专业的搜索引擎用户。你的首要任务是为用户给定的知识三元组生成有效的Google搜索查询，以便对其进行验证。
+请生成最多3个多样化且简洁的查询。
+"""
+
+QUERY_GENERATOR_USER_PROMPT = "知识三元组: {triple}"
+
+VERIFIER_SYSTEM_PROMPT = """
 你是一个高度精确的语言注释员。你的任务是判断“证据摘要”与“知识三元组”之间的关系。
 你的决策必须*仅仅*基于所提供的摘要。你的回答必须是单个词: Supports, Refutes, 或 Neutral。
 
 - Supports: 摘要直接陈述或强烈暗示该三元组为真。
 - Refutes: 摘要直接陈述或强烈暗示该三元组为假。
 - Neutral: 摘要不相关、模棱两可或信息不足。
+"""
 
-知识三元组: {triple}
-证据摘要:
+# 证据在前、三元组在后: 针对同一份证据的多次验证共享尽可能长的前缀
+VERIFIER_USER_PROMPT = """证据摘要:
 ---
 {snippets}
 ---
 
+知识三元组: {triple}
+
 你的单字回答:
 """
 
-ANSWERER_PROMPT = """
-你是一位智能且客观的问答机器人。你的任务是综合所有已验证的信息来回答用户的原始问题。
-你的最终答案应该简洁，并直接回应原始问题。
+BATCH_VERIFIER_SYSTEM_PROMPT = """
+你是一个高度精确的语言注释员。你的任务是逐一判断“证据摘要”与每个编号的“知识三元组”之间的关系。
+你的决策必须*仅仅*基于所提供的摘要。每个三元组的判断只能是: Supports, Refutes, 或 Neutral。
 
-原始问题: "{question}"
+- Supports: 摘要直接陈述或强烈暗示该三元组为真。
+- Refutes: 摘要直接陈述或强烈暗示该三元组为假。
+- Neutral: 摘要不相关、模棱两可或信息不足。
 
-已验证的外部证据:
+请为每个编号 i 给出一个判断。
+"""
+
+BATCH_VERIFIER_USER_PROMPT = """证据摘要:
+---
+{snippets}
+---
+
+知识三元组 (按编号 i):
+{triples}
+"""
+
+ANSWERER_SYSTEM_PROMPT = """
+你是一位智能且客观的问答机器人。你的任务是综合所有已验证的信息来回答用户的原始问题。
+你的最终答案应该简洁，并直接回应原始问题。请基于所提供的证据，为原始问题提供一个最终的、基于证据的答案。
+"""
+
+ANSWERER_USER_PROMPT = """已验证的外部证据:
 ---
 {verified_evidence}
 ---
 
-基于以上所有信息，请为原始问题提供一个最终的、基于证据的答案。
+原始问题: "{question}"
+"""
+
+JUDGE_SYSTEM_PROMPT = """
+你是一位严谨的问答评估员。请判断“生成答案”是否与“标准答案”在语义上一致，从而正确回答了问题。
+措辞、语言或详略不同不影响判断；只要核心事实一致即视为正确。
+请给出判断 (Correct 或 Incorrect)，并用一句话说明理由。
 """
 
+JUDGE_USER_PROMPT = """问题: "{question}"
+标准答案: "{ideal_answer}"
+生成答案: "{generated_answer}"
+"""
+
+def _compile_template(template: str):
+    """
+    在模块加载时将 {field} 模板预先拆分为静态片段与占位符，返回按关键字参数拼接的渲染函数。
+    每次调用只做一次 "".join，不再像 str.format 那样重新解析模板。
+    """
+    parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(template)]
+
+    def render(**values) -> str:
+        return "".join([literal + (str(values[field]) if field is not None else "") for literal, field in parts])
+    return render
+
+_render_hypothesizer = _compile_template(HYPOTHESIZER_USER_PROMPT)
+_render_query_generator = _compile_template(QUERY_GENERATOR_USER_PROMPT)
+_render_verifier = _compile_template(VERIFIER_USER_PROMPT)
+_render_batch_verifier = _compile_template(BATCH_VERIFIER_USER_PROMPT)
+_render_answerer = _compile_template(ANSWERER_USER_PROMPT)
+_render_judge = _compile_template(JUDGE_USER_PROMPT)
+
 # --- 智能体定义 ---
 
-def generate_graph(question: str) -> list:
+_NL_RE = re.compile(r'[\r\n]+')
+# 快速模型答案中出现这些回避措辞时升级到慢速模型
+_HEDGING_RE = re.compile(
+    r"无法确定|不确定|不清楚|无法判断|难以判断|信息不足|没有足够的信息|无法回答|"
+    r"not sure|uncertain|unclear|cannot determine|can't determine|not enough information",
+    re.IGNORECASE
+)
+
+# stream_answer 升级到慢速模型时产出的哨兵值，此前产出的文本应被丢弃
+ANSWER_ESCALATED = object()
+
+def _canonical_triple(triple: list) -> str:
     """
-    (假设器) 根据问题生成一个假设性知识图谱。
+    将三元组规范化为大小写与首尾空白无关的字符串，用作缓存键。
+    """
+    return "|".join(str(part).strip().lower() for part in triple)
+
+class _TripleStreamParser:
     """
-    raw_output = utils.call_llm(
-        prompt=HYPOTHESIZER_PROMPT.format(question=question),
+    增量解析 {"triples": [{...}, {...}]} 形式的JSON流: 用括号计数追踪嵌套深度 (忽略字符串内的括号)，
+    每当 triples 数组中的一个元素闭合，就立即将其解析为 Triple。
+    """
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._element = []
+
+    def feed(self, chunk: str) -> list:
+        triples = []
+        for char in chunk:
+            if self._depth >= 3:
+                self._element.append(char)
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+                if self._depth == 3:
+                    self._element = [char]
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 2:
+                    element = "".join(self._element)
+                    try:
+                        triples.append(Triple.model_validate_json(element))
+                    except ValidationError:
+                        print(f"[警告] 无法解析假设器输出的三元组: {element}")
+        return triples
+
+async def stream_graph(question: str):
+    """
+    (假设器) 以流式方式生成假设性知识图谱，每个三元组一旦生成完整就立即产出，
+    使下游的查询生成与验证可以在假设器仍在生成时开始。
+    """
+    parser = _TripleStreamParser()
+    async for chunk in utils.stream_llm(
+        prompt=_render_hypothesizer(question=question),
         model=config.HYPOTHESIZER_MODEL,
-        is_json=True
-    )
-    if not raw_output:
-        return []
-    try:
-        data = json.loads(raw_output)
-        return data.get("triples", [])
-    except (json.JSONDecodeError, AttributeError):
-        print(f"[警告] 无法从假设器输出中解析三元组: {raw_output}")
-        return []
+        system_prompt=HYPOTHESIZER_SYSTEM_PROMPT,
+        schema=HypothesisGraph,
+        semantic_key=question
+    ):
+        for triple in parser.feed(chunk):
+            yield [triple.subject, triple.relation, triple.object]
 
-def generate_queries(triple: list) -> list:
+async def generate_graph(question: str) -> list:
+    """
+    (假设器) 根据问题生成一个完整的假设性知识图谱。
+    """
+    return [triple async for triple in stream_graph(question)]
+
+async def generate_queries(triple: list) -> list:
     """
     (查询生成器) 为一个知识三元组生成搜索查询。
     """
-    raw_output = utils.call_llm(
-        prompt=QUERY_GENERATOR_PROMPT.format(triple=str(tuple(triple))),
+    triple_str = str(tuple(triple))
+    result = await utils.call_llm(
+        prompt=_render_query_generator(triple=triple_str),
         model=config.QUERY_GENERATOR_MODEL,
-        is_json=True
+        system_prompt=QUERY_GENERATOR_SYSTEM_PROMPT,
+        schema=SearchQueries,
+        semantic_key=triple_str
     )
-    if not raw_output:
-        return []
-    try:
-        data = json.loads(raw_output)
-        return data.get("queries", [])
-    except (json.JSONDecodeError, AttributeError):
-        print(f"[警告] 无法从查询生成器输出中解析查询: {raw_output}")
-        return []
+    return result.queries if result else []
 
-def verify(triple: list, snippets: str) -> str:
+def _triple_hypothesis(triple: list) -> str:
     """
-    (验证器) 判断证据摘要是否支持知识三元组。
+    将三元组转换为NLI模型的假设句。
     """
-    if not snippets or snippets == "SEARCH_API_ERROR":
-        return "Neutral"
+    return " ".join(str(part).strip() for part in triple)
 
-    response = utils.call_llm(
-        prompt=VERIFIER_PROMPT.format(triple=str(tuple(triple)), snippets=snippets),
-        model=config.VERIFIER_MODEL
+async def _llm_verify(triple: list, snippets: str) -> str:
+    """
+    (生成式验证器) 用LLM判断证据摘要是否支持知识三元组。
+    """
+    # 以 (规范化三元组, 证据哈希) 作为缓存键，相同证据不会重复验证
+    snippets_hash = hashlib.sha256(snippets.encode("utf-8")).hexdigest()
+    response = await utils.call_llm(
+        prompt=_render_verifier(snippets=snippets, triple=str(tuple(triple))),
+        model=config.VERIFIER_MODEL,
+        system_prompt=VERIFIER_SYSTEM_PROMPT,
+        cache_key=f"verify:{_canonical_triple(triple)}:{snippets_hash}"
     )
     return response if response in ["Supports", "Refutes", "Neutral"] else "Neutral"
 
-def generate_answer(question: str, verified_evidence: list) -> str:
+async def _llm_verify_batch(triples: list, snippets: str) -> list:
+    """
+    (生成式验证器) 在一次LLM调用中判断同一份证据摘要是否支持多个知识三元组，
+    共享证据的预填充只需计算一次。
+    """
+    if len(triples) == 1:
+        return [await _llm_verify(triples[0], snippets)]
+
+    numbered_triples = "\n".join(f"{i}. {tuple(triple)}" for i, triple in enumerate(triples))
+    snippets_hash = hashlib.sha256(snippets.encode("utf-8")).hexdigest()
+    canonical_triples = "||".join(_canonical_triple(triple) for triple in triples)
+    result = await utils.call_llm(
+        prompt=_render_batch_verifier(snippets=snippets, triples=numbered_triples),
+        model=config.VERIFIER_MODEL,
+        system_prompt=BATCH_VERIFIER_SYSTEM_PROMPT,
+        schema=BatchVerdicts,
+        cache_key=f"verify_batch:{canonical_triples}:{snippets_hash}"
+    )
+    verdicts = {decision.i: decision.verdict for decision in result.decisions} if result else {}
+    return [verdicts.get(i, "Neutral") for i in range(len(triples))]
+
+async def verify(triple: list, snippets: str) -> str:
+    """
+    (验证器) 判断证据摘要是否支持知识三元组。
+    """
+    return (await verify_batch([triple], snippets))[0]
+
+async def verify_batch(triples: list, snippets: str) -> list:
+    """
+    (验证器) 判断同一份证据摘要是否支持多个知识三元组。
+
+    优先使用本地NLI模型在一个批次中完成判断；置信度低于 config.NLI_CONFIDENCE_THRESHOLD
+    的三元组再交给生成式LLM验证器。config.NLI_VERIFIER_MODEL 为None时全部使用LLM。
+
+    Returns:
+        list: 与 triples 一一对应的 Supports / Refutes / Neutral 判断。
+    """
+    if not snippets or snippets == "SEARCH_API_ERROR":
+        return ["Neutral"] * len(triples)
+    snippets = utils.truncate_tokens(snippets, config.MAX_SNIPPET_TOKENS)
+    if not config.NLI_VERIFIER_MODEL:
+        return await _llm_verify_batch(triples, snippets)
+
+    hypotheses = [_triple_hypothesis(triple) for triple in triples]
+    predictions = await runtime.run_blocking(nli.classify, snippets, hypotheses)
+    verdicts = [verdict for verdict, _ in predictions]
+
+    uncertain_ids = [i for i, (_, confidence) in enumerate(predictions) if confidence < config.NLI_CONFIDENCE_THRESHOLD]
+    if uncertain_ids:
+        fallback_verdicts = await _llm_verify_batch([triples[i] for i in uncertain_ids], snippets)
+        for i, verdict in zip(uncertain_ids, fallback_verdicts):
+            verdicts[i] = verdict
+    return verdicts
+
+def _should_escalate(answer: str, token_logprobs: list) -> bool:
+    """
+    判断快速模型的答案是否需要升级到慢速模型: 答案为空、平均token对数概率过低或含有回避措辞。
+    服务商未返回logprobs时只依据回避措辞判断。
+    """
+    if not answer.strip():
+        return True
+    if token_logprobs and sum(token_logprobs) / len(token_logprobs) < config.ANSWERER_MIN_MEAN_LOGPROB:
+        return True
+    return bool(_HEDGING_RE.search(answer))
+
+async def stream_answer(question: str, verified_evidence: list):
     """
-    (回答器) 基于已验证的证据生成最终答案。
+    (回答器) 基于已验证的证据以流式方式生成最终答案，逐块产出文本。
+
+    采用模型级联: 先用 config.ANSWERER_FAST_MODEL 作答；若答案的平均token对数概率过低、
+    含有回避措辞，或已验证事实超过 config.ANSWERER_ESCALATION_MAX_FACTS 条，
+    则升级到 config.ANSWERER_SLOW_MODEL: 先产出 ANSWER_ESCALATED 通知调用方丢弃已收到的
+    快速答案文本，再产出慢速模型的答案。
     """
     if not verified_evidence:
-        return "抱歉，经过验证，我没有足够的信息来回答这个问题。"
+        yield "抱歉，经过验证，我没有足够的信息来回答这个问题。"
+        return
+
+    # 只保留token预算内与问题最相关的事实，控制预填充长度
+    verified_evidence = utils.select_evidence(question, verified_evidence, config.MAX_EVIDENCE_TOKENS)
+    # 将已验证的事实格式化为清晰的上下文，证据内部的换行折叠为空格
+    evidence_str = "\n\n".join(
+        f"- 事实: {fact['triple']}\n  证据: {_NL_RE.sub(' ', fact['evidence'])}" for fact in verified_evidence
+    )
+    prompt = _render_answerer(verified_evidence=evidence_str, question=question)
+
+    if len(verified_evidence) <= config.ANSWERER_ESCALATION_MAX_FACTS:
+        token_logprobs, chunks = [], []
+        async for chunk in utils.stream_llm(
+            prompt=prompt,
+            model=config.ANSWERER_FAST_MODEL,
+            system_prompt=ANSWERER_SYSTEM_PROMPT,
+            token_logprobs=token_logprobs
+        ):
+            chunks.append(chunk)
+            yield chunk
+        if not _should_escalate("".join(chunks), token_logprobs):
+            return
 
-    # 将已验证的事实格式化为清晰的上下文
-    evidence_str = ""
-    for fact in verified_evidence:
-        evidence_str += f"- 事实: {fact['triple']}\\n"
-        evidence_str += f"  证据: {fact['evidence'].replace('\\n', ' ')}\\n\\n"
+    yield ANSWER_ESCALATED
+    has_output = False
+    async for chunk in utils.stream_llm(
+        prompt=prompt,
+        model=config.ANSWERER_SLOW_MODEL,
+        system_prompt=ANSWERER_SYSTEM_PROMPT
+    ):
+        has_output = True
+        yield chunk
+    if not has_output:
+        yield "在生成最终答案时出错。"
 
-    response = utils.call_llm(
-        prompt=ANSWERER_PROMPT.format(question=question, verified_evidence=evidence_str),
-        model=config.ANSWERER_MODEL
+async def generate_answer(question: str, verified_evidence: list) -> tuple:
+    """
+    (回答器) 基于已验证的证据生成完整的最终答案。
+
+    Returns:
+        tuple: (最终答案, 是否升级到了慢速模型)
+    """
+    chunks, escalated = [], False
+    async for chunk in stream_answer(question, verified_evidence):
+        if chunk is ANSWER_ESCALATED:
+            chunks, escalated = [], True
+        else:
+            chunks.append(chunk)
+    return "".join(chunks).strip(), escalated
+
+async def evaluate_answer(question: str, ideal_answer: str, generated_answer: str) -> dict:
+    """
+    (裁判) 判断生成的答案是否与标准答案一致，供评估框架使用。
+    """
+    generated_answer = utils.truncate_tokens(generated_answer, config.MAX_JUDGE_ANSWER_TOKENS)
+    verdict = await utils.call_llm(
+        prompt=_render_judge(question=question, ideal_answer=ideal_answer, generated_answer=generated_answer),
+        model=config.JUDGE_MODEL,
+        system_prompt=JUDGE_SYSTEM_PROMPT,
+        schema=JudgeVerdict
     )
-    return response if response else "在生成最终答案时出错。"
\ No newline at end of file
+    if not verdict:
+        return {"decision": "Incorrect", "reasoning": "裁判模型调用失败。"}
+    return verdict.model_dump()
\ No newline at end of file
@@ -0,0 +1,198 @@
+# mvp/cache.py
+
+import hashlib
+import sqlite3
+import threading
+import functools
+import numpy as np
+import orjson
+import config
+import runtime
+
+# --- 两级LLM响应缓存 ---
+# 第一级: SHA256(model + 调用参数 + prompt) 精确匹配
+# 第二级: 对提示中的动态部分 (如问题、三元组) 计算句向量，余弦相似度超过阈值即视为命中
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS exact_cache (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS semantic_cache (
+    namespace TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    response TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_semantic_namespace ON semantic_cache (namespace);
+"""
+
+def _sha256(*parts) -> str:
+    return hashlib.sha256("\x1f".join(part or "" for part in parts).encode("utf-8")).hexdigest()
+
+@runtime.locked_cache
+def _embedder():
+    # 延迟导入: 只有在第一次语义查找时才加载 torch 和嵌入模型
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(config.SEMANTIC_CACHE_MODEL)
+
+def _embed(text: str) -> np.ndarray:
+    return _embedder().encode(text, normalize_embeddings=True).astype(np.float32)
+
+class ResponseCache:
+    """
+    基于SQLite的持久化响应缓存，语义索引在内存中按命名空间维护。
+    """
+
+    def __init__(self, path: str, threshold: float):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(_SCHEMA)
+        # namespace -> (归一化嵌入矩阵, 响应列表)
+        self._semantic_index = {}
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM exact_cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, response: str):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO exact_cache (key, response) VALUES (?, ?)", (key, response))
+            self._conn.commit()
+
+    def _load_namespace(self, namespace: str):
+        if namespace not in self._semantic_index:
+            rows = self._conn.execute(
+                "SELECT embedding, response FROM semantic_cache WHERE namespace = ?", (namespace,)
+            ).fetchall()
+            embeddings = [np.frombuffer(blob, dtype=np.float32) for blob, _ in rows]
+            matrix = np.vstack(embeddings) if embeddings else None
+            self._semantic_index[namespace] = (matrix, [response for _, response in rows])
+        return self._semantic_index[namespace]
+
+    def search_semantic(self, namespace: str, embedding: np.ndarray):
+        """
+        在同一命名空间内查找与给定嵌入最相似的已缓存响应 (内积即余弦相似度)。
+        """
+        with self._lock:
+            matrix, responses = self._load_namespace(namespace)
+        if matrix is None:
+            return None
+        similarities = matrix @ embedding
+        best = int(np.argmax(similarities))
+        return responses[best] if similarities[best] > self.threshold else None
+
+    def put_semantic(self, namespace: str, embedding: np.ndarray, response: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO semantic_cache (namespace, embedding, response) VALUES (?, ?, ?)",
+                (namespace, embedding.tobytes(), response)
+            )
+            self._conn.commit()
+            matrix, responses = self._load_namespace(namespace)
+            matrix = embedding[None, :] if matrix is None else np.vstack([matrix, embedding])
+            self._semantic_index[namespace] = (matrix, responses + [response])
+
+@functools.cache
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(config.LLM_CACHE_PATH, config.SEMANTIC_CACHE_THRESHOLD)
+
+async def _lookup(model: str, prompt: str, options: dict, cache_key: str, semantic_key: str):
+    """
+    依次查询精确缓存与语义缓存。
+
+    Returns:
+        tuple: (命中的响应或None, 写回缓存时所需的 (exact_key, namespace, embedding))
+    """
+    cache = get_response_cache()
+    # system_prompt、response_format 等调用参数同样影响输出，一并计入键
+    options_str = orjson.dumps(options, option=orjson.OPT_SORT_KEYS, default=str).decode("utf-8")
+    exact_key = _sha256(model, options_str, cache_key or prompt)
+    response = cache.get(exact_key)
+    if response is not None:
+        return response, None
+
+    namespace = embedding = None
+    if semantic_key:
+        # 去掉动态部分后的模板决定命名空间，避免不同智能体的提示互相命中；
+        # 嵌入模型也计入命名空间，更换模型后不会与旧向量比较
+        namespace = _sha256(config.SEMANTIC_CACHE_MODEL, model, options_str, prompt.replace(semantic_key, ""))
+        embedding = await runtime.run_blocking(_embed, semantic_key)
+        response = cache.search_semantic(namespace, embedding)
+        if response is not None:
+            cache.put(exact_key, response)
+            return response, None
+    return None, (exact_key, namespace, embedding)
+
+def _store(slot: tuple, response: str):
+    exact_key, namespace, embedding = slot
+    cache = get_response_cache()
+    cache.put(exact_key, response)
+    if namespace:
+        cache.put_semantic(namespace, embedding, response)
+
+def cached_llm_call(func):
+    """
+    为异步LLM调用函数添加两级缓存的装饰器。
+
+    被装饰的函数额外接受以下仅限关键字的参数:
+        cache_key (str, optional): 替代完整提示参与精确匹配的键 (如验证器的规范化三元组+证据哈希)。
+        semantic_key (str, optional): 提示中的动态部分，提供时启用语义缓存。
+        bypass_cache (bool): 为True时跳过缓存，用于非确定性调用。
+    """
+    @functools.wraps(func)
+    async def wrapper(prompt: str, model: str, *, cache_key: str = None, semantic_key: str = None,
+                      bypass_cache: bool = False, **kwargs):
+        if bypass_cache:
+            return await func(prompt=prompt, model=model, **kwargs)
+
+        response, slot = await _lookup(model, prompt, kwargs, cache_key, semantic_key)
+        if response is not None:
+            return response
+
+        response = await func(prompt=prompt, model=model, **kwargs)
+        if response is not None:
+            _store(slot, response)
+        return response
+    return wrapper
+
+def cached_llm_stream(func):
+    """
+    cached_llm_call 的流式版本，用于产出文本块的异步生成器。
+    命中时一次性产出完整的缓存响应；未命中时边转发边累积，只有流正常结束才写入缓存。
+    调用方传入 token_logprobs 列表时，响应与其token对数概率一并缓存，命中时同样填充该列表。
+    """
+    @functools.wraps(func)
+    async def wrapper(prompt: str, model: str, *, cache_key: str = None, semantic_key: str = None,
+                      bypass_cache: bool = False, **kwargs):
+        if bypass_cache:
+            async for chunk in func(prompt=prompt, model=model, **kwargs):
+                yield chunk
+            return
+
+        token_logprobs = kwargs.get("token_logprobs")
+        # 列表本身不参与键，只区分是否请求了logprobs (两种条目的存储格式不同)
+        options = {name: value for name, value in kwargs.items() if name != "token_logprobs"}
+        if token_logprobs is not None:
+            options["logprobs"] = True
+        response, slot = await _lookup(model, prompt, options, cache_key, semantic_key)
+        if response is not None:
+            if token_logprobs is not None:
+                entry = orjson.loads(response)
+                token_logprobs.extend(entry["logprobs"])
+                response = entry["text"]
+            yield response
+            return
+
+        chunks = []
+        first_logprob = len(token_logprobs) if token_logprobs is not None else 0
+        async for chunk in func(prompt=prompt, model=model, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        if chunks:
+            response = "".join(chunks)
+            if token_logprobs is not None:
+                response = orjson.dumps({"text": response, "logprobs": token_logprobs[first_logprob:]}).decode("utf-8")
+            _store(slot, response)
+    return wrapper
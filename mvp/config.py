@@ -1,19 +1,33 @@
 # mvp/config.py
 
-import os
-from dotenv import load_dotenv
-
-# 加载 .env 文件中的环境变量
-load_dotenv()
+import functools
+from pydantic import ValidationError
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # --- 核心API配置 ---
-# 检查并加载必要的环境变量
-OPENKEY_API_KEY = os.environ.get("OPENKEY_API_KEY")
-OPENKEY_BASE_URL = os.environ.get("OPENKEY_BASE_URL", "https://openkey.cloud/v1")
-SERPER_API_KEY = os.environ.get("SERPER_API_KEY")
+# 从环境变量或 .env 文件加载；只在第一次使用时读取和校验，导入本模块不需要任何密钥
+
+class ConfigurationError(ValueError):
+    """
+    缺少必要配置时抛出。调用方不应吞掉该异常，应直接终止运行。
+    """
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    openkey_api_key: str
+    openkey_base_url: str = "https://openkey.cloud/v1"
+    serper_api_key: str
 
-if not all([OPENKEY_API_KEY, SERPER_API_KEY]):
-    raise ValueError("错误: 缺少必要的环境变量: OPENROUTER_API_KEY, SERPER_API_KEY")
+@functools.cache
+def get_settings() -> Settings:
+    """
+    返回进程内共享的配置对象，缺少必要的环境变量时抛出异常。
+    """
+    try:
+        return Settings()
+    except ValidationError as e:
+        raise ConfigurationError("错误: 缺少必要的环境变量: OPENKEY_API_KEY, SERPER_API_KEY") from e
 
 # --- 模型选择 ---
 # 您可以根据性能和成本需求更换这些模型
@@ -24,7 +38,52 @@ QUERY_GENERATOR_MODEL = "gemini-2.5-flash-lite"
 # 用于判断证据是否支持三元组的验证器模型 (来自实验 3)
 VERIFIER_MODEL = "gemini-2.5-flash"
 # 用于基于已验证的证据生成最终答案的规划/回答模型 (来自实验 4)
-ANSWERER_MODEL = "gemini-2.5-pro"
+# 回答器采用级联: 先用快速模型作答，置信度不足时再升级到慢速模型
+ANSWERER_FAST_MODEL = "gemini-2.5-flash"
+ANSWERER_SLOW_MODEL = "gemini-2.5-pro"
+# 评估框架中用于判断答案是否正确的裁判模型
+JUDGE_MODEL = "gemini-2.5-flash"
 
 # --- API调用参数 ---
-LLM_TEMPERATURE = 0.1 # 较低的温度以获得更确定的输出
\ No newline at end of file
+LLM_TEMPERATURE = 0.1 # 较低的温度以获得更确定的输出
+LLM_MAX_ATTEMPTS = 5 # 遇到限流等可重试错误时的最大尝试次数
+# 快速答案的平均token对数概率低于该值时升级到慢速模型
+ANSWERER_MIN_MEAN_LOGPROB = -1.0
+# 已验证事实超过该数量的问题直接交给慢速模型
+ANSWERER_ESCALATION_MAX_FACTS = 6
+# 验证阶段同时进行的“搜索+验证”请求数量上限
+MAX_CONCURRENT_REQUESTS = 8
+# 字符3-gram Jaccard相似度超过该阈值的查询视为近似重复，只搜索一次
+QUERY_DEDUP_THRESHOLD = 0.8
+# 共享线程池的线程数，用于嵌入计算和NLI推理 (模型内部已多线程，无需太多)
+BLOCKING_WORKERS = 4
+
+# --- LLM响应缓存 ---
+# 精确缓存与语义缓存共用的SQLite文件
+LLM_CACHE_PATH = "./data/llm_cache.sqlite3"
+# 语义缓存使用的句向量模型: 问题与三元组多为中文，需使用多语言模型；纯英文模型对中文文本的
+# 相似度不可靠，误命中会返回另一个问题的假设图谱或另一个三元组的查询
+SEMANTIC_CACHE_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# 余弦相似度超过该阈值时视为语义命中
+SEMANTIC_CACHE_THRESHOLD = 0.95
+
+# --- 推测执行 ---
+# 已验证事实达到该数量后即开始推测性地起草答案
+SPECULATIVE_ANSWER_MIN_FACTS = 2
+
+# --- 本地NLI验证器 ---
+# 用于判断证据是否蕴含三元组的交叉编码器模型；设为None则始终使用生成式LLM验证器 (VERIFIER_MODEL)
+# 问题与三元组多为中文而搜索摘要常为英文，因此使用支持跨语言推理的多语言 (XNLI) 模型
+NLI_VERIFIER_MODEL = "MoritzLaurer/mDeBERTa-v3-base-xnli-multilingual-nli-2mil7"
+# NLI最高类别概率低于该阈值时，回退到LLM验证器
+NLI_CONFIDENCE_THRESHOLD = 0.6
+
+# --- Token预算 ---
+# 用于估算token数的tiktoken分词器 (与服务商的分词器近似即可)
+TOKENIZER_MODEL = "gpt-4o"
+# 回答器输入中已验证事实与证据的总token上限
+MAX_EVIDENCE_TOKENS = 2048
+# 验证器输入中单份证据摘要的token上限
+MAX_SNIPPET_TOKENS = 512
+# 裁判输入中生成答案的token上限
+MAX_JUDGE_ANSWER_TOKENS = 512
@@ -1,91 +1,184 @@
 # evaluation.py (Revised with sample limiting)
-import json
+import mmap
 import time
+import orjson
+import asyncio
 from datetime import datetime
 import agents
+import runtime
 from main import run_pipeline
 from rich.console import Console
 from rich.table import Table
+from tqdm.asyncio import tqdm_asyncio
 import numpy as np
 
 console = Console()
 
 LOG_FILE = "./data/evaluation_log.md"
 
-def load_jsonl_test_suite(file_path: str):
-    """Loads a test suite from a JSON Lines (.jsonl) file."""
-    data = []
+# Byte lookup table: True for bytes that are not ASCII whitespace (what bytes.strip() removes)
+_IS_CONTENT_BYTE = np.ones(256, dtype=bool)
+_IS_CONTENT_BYTE[list(b" \t\n\r\x0b\x0c")] = False
+
+def _line_offsets(mm: mmap.mmap) -> np.ndarray:
+    """Returns the start offset of every line in a memory-mapped file that is not whitespace-only."""
+    buffer = np.frombuffer(mm, dtype=np.uint8)
+    starts = np.concatenate(([0], np.flatnonzero(buffer == ord("\n")) + 1))
+    starts = starts[starts < len(buffer)]
+    if len(starts):
+        # Logical OR of the content flags over each line, the same test the sequential path makes with line.strip()
+        starts = starts[np.logical_or.reduceat(_IS_CONTENT_BYTE[buffer], starts)]
+    del buffer # release the export so the mmap can be closed
+    return starts
+
+def load_jsonl_test_suite(file_path: str, max_samples: int = None, sample_seed: int = None):
+    """
+    Loads a test suite from a JSON Lines (.jsonl) file.
+
+    The file is memory-mapped and only the lines that are used get parsed:
+    all of them, the first `max_samples` lines, or - when `sample_seed` is
+    given - `max_samples` lines drawn at random from a line-offset index.
+    """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                data.append(json.loads(line))
-        return data
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if max_samples and max_samples > 0 and sample_seed is not None:
+                offsets = _line_offsets(mm)
+                rng = np.random.default_rng(sample_seed)
+                picked = np.sort(rng.choice(len(offsets), size=min(max_samples, len(offsets)), replace=False))
+                data = []
+                for offset in offsets[picked]:
+                    mm.seek(int(offset))
+                    data.append(orjson.loads(mm.readline()))
+                return data
+
+            data = []
+            for line in iter(mm.readline, b""):
+                if line.strip():
+                    data.append(orjson.loads(line))
+                    if max_samples and len(data) == max_samples:
+                        break
+            return data
     except FileNotFoundError:
         console.print(f"[bold red]Error: Test suite file not found at '{file_path}'[/bold red]")
         return []
-    except json.JSONDecodeError as e:
-        console.print(f"[bold red]Error decoding JSON on a line in {file_path}: {e}[/bold red]")
+    except ValueError as e: # includes orjson.JSONDecodeError and mmap of an empty file
+        console.print(f"[bold red]Error reading test suite {file_path}: {e}[/bold red]")
         return []
 
-def log_failure(test_case, result, reasoning):
-    """Appends the details of a failed test case to the log file."""
-    with open(LOG_FILE, 'a', encoding='utf-8') as f:
-        f.write(f"### ❌ Failure: {test_case['question']}\n")
-        f.write(f"- **Ideal Answer:** `{test_case.get('answer', 'N/A')}`\n")
-        f.write(f"- **Generated Answer:** `{result.get('final_answer', 'N/A')}`\n")
-        f.write(f"- **Judge's Reasoning:** *{reasoning}*\n")
-        f.write("- **Verified Facts Fed to Answerer:**\n")
-        verified_facts = result.get('verified_facts', [])
-        if verified_facts:
-            for fact in verified_facts:
-                f.write(f"  - `{fact.get('triple', 'N/A')}`\n")
-        else:
-            f.write("  - (No facts were verified)\n")
-        f.write("\n---\n")
-
-# The new parameter `max_samples` is added here
-def run_evaluation_framework(max_samples: int = None):
-    """Main function to run the full evaluation suite."""
+def log_failure(log_file, test_case, result, reasoning):
+    """
+    Appends the details of a failed test case to the already-open log file.
+
+    The entry is written without awaiting, so concurrent test cases on the
+    event loop cannot interleave their entries.
+    """
+    lines = [
+        f"### ❌ Failure: {test_case['question']}\n",
+        f"- **Ideal Answer:** `{test_case.get('answer', 'N/A')}`\n",
+        f"- **Generated Answer:** `{result.get('final_answer', 'N/A')}`\n",
+        f"- **Judge's Reasoning:** *{reasoning}*\n",
+        "- **Verified Facts Fed to Answerer:**\n",
+    ]
+    verified_facts = result.get('verified_facts', [])
+    if verified_facts:
+        lines.extend(f"  - `{fact.get('triple', 'N/A')}`\n" for fact in verified_facts)
+    else:
+        lines.append("  - (No facts were verified)\n")
+    lines.append("\n---\n")
+    log_file.writelines(lines)
+
+class RunningStats:
+    """Single-pass mean/std accumulator (Welford's algorithm)."""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value: float):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self) -> float:
+        # Population std, matching the previous np.std default
+        return (self._m2 / self.n) ** 0.5 if self.n else 0.0
+
+def bootstrap_ci(values: np.ndarray, n_resamples: int = 10_000, confidence: float = 0.95, seed: int = 0):
+    """
+    Percentile bootstrap confidence interval of the mean.
+
+    Resamples are drawn as one (resamples x n) index matrix per block and
+    reduced with a single vectorized mean; blocks bound the index matrix to
+    a few million entries however large the test suite is.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(values)
+    means = np.empty(n_resamples)
+    block = max(1, (1 << 22) // n)
+    for start in range(0, n_resamples, block):
+        stop = min(start + block, n_resamples)
+        means[start:stop] = values[rng.integers(0, n, size=(stop - start, n))].mean(axis=1)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+async def run_single_test(test_case: dict, semaphore: asyncio.Semaphore, log_file):
+    """Runs the pipeline and the LLM judge for one test case."""
+    question = test_case.get("question", "No question found in test case")
+    ideal_answer = test_case.get("answer", "")
+
+    async with semaphore:
+        pipeline_result = await run_pipeline(question, verbose=False)
+        # --- Use the LLM to evaluate the answer ---
+        evaluation_result = await agents.evaluate_answer(question, ideal_answer, pipeline_result['final_answer'])
+
+    decision = evaluation_result.get("decision", "Incorrect")
+    reasoning = evaluation_result.get("reasoning", "N/A")
+    success = 1 if decision == "Correct" else 0
+
+    if not success:
+        log_failure(log_file, test_case, pipeline_result, reasoning)
+
+    console.print(f"[green]Finished:[/green] {question} -> {'✔ Correct' if success else '✖ Incorrect'}, TTFT: {pipeline_result['time_to_first_token']:.2f}s, Latency: {pipeline_result['latency']:.2f}s")
+    return {
+        "question": question,
+        "success": success,
+        "latency": pipeline_result['latency'],
+        "time_to_first_token": pipeline_result['time_to_first_token'],
+        "escalated": pipeline_result['escalated']
+    }
+
+async def run_evaluation_framework(max_samples: int = None, max_in_flight: int = 16, sample_seed: int = None):
+    """
+    Main function to run the full evaluation suite.
+
+    All test cases run concurrently on one event loop; `max_in_flight` bounds
+    how many pipelines (and their judge calls) are active at the same time.
+    With `max_samples`, only the first lines are evaluated, or a random subset
+    of lines when `sample_seed` is given.
+    """
     console.print("[bold cyan]Starting Quantitative Evaluation Framework...[/bold cyan]", justify="center")
     
     test_suite_path = "./data/hotpotqa_test_set.jsonl"
-    test_suite = load_jsonl_test_suite(test_suite_path)
+    test_suite = load_jsonl_test_suite(test_suite_path, max_samples, sample_seed)
     if not test_suite:
         return
     
-    with open(LOG_FILE, 'a', encoding='utf-8') as f:
-        f.write(f"\n## Test Run: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n---\n")
-
     if max_samples and max_samples > 0:
-        console.print(f"[yellow]Running on the first {min(max_samples, len(test_suite))} of {len(test_suite)} samples.[/yellow]")
-        test_suite = test_suite[:max_samples]
+        selection = "first" if sample_seed is None else f"randomly sampled (seed {sample_seed})"
+        console.print(f"[yellow]Running on the {selection} {len(test_suite)} samples.[/yellow]")
 
-    results = []
-    
-    for i, test_case in enumerate(test_suite):
-        console.print(f"\n--- Running Test Case {i+1}/{len(test_suite)} ---")
-        question = test_case.get("question", "No question found in test case")
-        console.print(f"[yellow]Question:[/yellow] {question}")
-        
-        pipeline_result = run_pipeline(question, verbose=False)
-        ideal_answer = test_case.get("answer", "")
-        
-        # --- NEW: Use the LLM to evaluate the answer ---
-        console.print("   - [purple]Asking LLM Judge for evaluation...[/purple]")
-        evaluation_result = agents.evaluate_answer(question, ideal_answer, pipeline_result['final_answer'])
-        decision = evaluation_result.get("decision", "Incorrect")
-        reasoning = evaluation_result.get("reasoning", "N/A")
-        success = 1 if decision == "Correct" else 0
-        
-        if not success:
-            log_failure(test_case, pipeline_result, reasoning)
-            
-        results.append({
-            "question": question,
-            "success": success,
-            "latency": pipeline_result['latency']
-        })
-        console.print(f"[green]Finished.[/green] Judge's Decision: {'✔ Correct' if success else '✖ Incorrect'}, Latency: {pipeline_result['latency']:.2f}s")
+    # The log is opened once for the whole run with a large buffer and flushed on close
+    with open(LOG_FILE, 'a', encoding='utf-8', buffering=1 << 16) as log_file:
+        log_file.write(f"\n## Test Run: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n---\n")
+        semaphore = asyncio.Semaphore(max_in_flight)
+        results = await tqdm_asyncio.gather(
+            *[run_single_test(test_case, semaphore, log_file) for test_case in test_suite],
+            desc="Evaluating"
+        )
 
     if not results:
         console.print("[bold red]No results to display.[/bold red]")
@@ -95,17 +188,36 @@ def run_evaluation_framework(max_samples: int = None):
     table.add_column("Metric", style="cyan", no_wrap=True)
     table.add_column("Average", style="magenta")
     table.add_column("Std. Dev.", style="green")
+    table.add_column("95% CI", style="yellow")
+
+    successes = 0
+    escalations = 0
+    latency = RunningStats()
+    time_to_first_token = RunningStats()
+    for r in results:
+        successes += r['success']
+        escalations += r['escalated']
+        latency.add(r['latency'])
+        time_to_first_token.add(r['time_to_first_token'])
+    avg_success_rate = successes / len(results) * 100
+    escalation_rate = escalations / len(results) * 100
 
-    avg_success_rate = np.mean([r['success'] for r in results]) * 100
-    avg_latency = np.mean([r['latency'] for r in results])
-    std_latency = np.std([r['latency'] for r in results])
+    # Columnar copies of the per-case results for the bootstrap resampling
+    success_ci = bootstrap_ci(np.fromiter((r['success'] for r in results), dtype=np.uint8, count=len(results)))
+    ttft_ci = bootstrap_ci(np.fromiter((r['time_to_first_token'] for r in results), dtype=np.float64, count=len(results)))
+    latency_ci = bootstrap_ci(np.fromiter((r['latency'] for r in results), dtype=np.float64, count=len(results)))
 
-    table.add_row("Task Success Rate", f"{avg_success_rate:.2f}%", "---")
-    table.add_row("Latency (seconds)", f"{avg_latency:.3f}s", f"{std_latency:.3f}s")
+    table.add_row("Task Success Rate", f"{avg_success_rate:.2f}%", "---",
+                  f"[{success_ci[0] * 100:.2f}%, {success_ci[1] * 100:.2f}%]")
+    table.add_row("Answerer Escalation Rate", f"{escalation_rate:.2f}%", "---", "---")
+    table.add_row("Time to First Token (seconds)", f"{time_to_first_token.mean:.3f}s", f"{time_to_first_token.std:.3f}s",
+                  f"[{ttft_ci[0]:.3f}s, {ttft_ci[1]:.3f}s]")
+    table.add_row("Latency (seconds)", f"{latency.mean:.3f}s", f"{latency.std:.3f}s",
+                  f"[{latency_ci[0]:.3f}s, {latency_ci[1]:.3f}s]")
     
     console.print("\n")
     console.print(table)
 
 
 if __name__ == "__main__":
-    run_evaluation_framework(max_samples=10)
\ No newline at end of file
+    runtime.run(run_evaluation_framework(max_samples=10))
\ No newline at end of file
@@ -1,76 +1,335 @@
 # mvp/main.py
 
+import re
 import time
+import asyncio
+import contextlib
 import agents
+import config
+import runtime
 import utils
 from rich.console import Console
+from rich.live import Live
 from rich.panel import Panel
+from rich.text import Text
 
 # 初始化一个漂亮的打印控制台
 console = Console()
+# verbose=False 时使用的静默控制台
+_quiet_console = Console(quiet=True)
 
-def run_pipeline(question: str):
+_WHITESPACE_RE = re.compile(r'\s+')
+
+def _normalize_query(query: str) -> str:
     """
-    执行完整的“假设-验证”问答流水线。
+    将查询规范化为小写、空白折叠且词序无关的形式。
     """
-    console.print(Panel(f"[bold yellow]🤔 正在处理问题: [/bold yellow]{question}", title="[bold green]开始[/bold green]", border_style="green"))
+    return " ".join(sorted(_WHITESPACE_RE.sub(' ', query.strip().lower()).split(' ')))
 
-    # --- 步骤 1: 假设 (Hypothesize) ---
-    start_time = time.time()
-    console.print("\\n[bold cyan]步骤 1: 生成假设性知识图谱...[/bold cyan]")
-    hypothesis_graph = agents.generate_graph(question)
-    console.print(f"   - [green]完成[/green] ({time.time() - start_time:.2f}秒)")
+def _char_ngrams(text: str, n: int = 3) -> set:
+    text = text.replace(' ', '')
+    return {text[i:i + n] for i in range(max(len(text) - n + 1, 1))}
 
-    if not hypothesis_graph:
-        console.print("[bold red]无法生成假设图谱。流程终止。[/bold red]")
-        return
+class _QueryIndex:
+    """
+    增量式查询去重: 规范化后完全相同，或字符3-gram的Jaccard相似度
+    超过 config.QUERY_DEDUP_THRESHOLD 的查询共享同一个ID。
+    """
 
-    console.print("   - [bold]生成的假设:[/bold]")
-    for triple in hypothesis_graph:
-        console.print(f"     - {triple}")
+    def __init__(self):
+        self.queries = []
+        self.total_added = 0
+        self._ngrams = []
+        self._id_by_normalized = {}
 
-    # --- 步骤 2: 验证 (Verify) ---
-    console.print("\\n[bold cyan]步骤 2: 验证每个假设三元组...[/bold cyan]")
-    verified_facts = []
-    for triple in hypothesis_graph:
-        start_time_triple = time.time()
-        console.print(f"   - [bold]正在验证:[/bold] {triple}")
+    def add(self, query: str) -> int:
+        self.total_added += 1
+        normalized = _normalize_query(query)
+        query_id = self._id_by_normalized.get(normalized)
+        if query_id is None:
+            ngrams = _char_ngrams(normalized)
+            for candidate_id, candidate_ngrams in enumerate(self._ngrams):
+                jaccard = len(ngrams & candidate_ngrams) / len(ngrams | candidate_ngrams)
+                if jaccard > config.QUERY_DEDUP_THRESHOLD:
+                    query_id = candidate_id
+                    break
+            else:
+                query_id = len(self.queries)
+                self.queries.append(query)
+                self._ngrams.append(ngrams)
+            self._id_by_normalized[normalized] = query_id
+        return query_id
 
-        queries = agents.generate_queries(triple)
-        if not queries:
-            console.print("     - [yellow]警告: 未能生成搜索查询。[/yellow]")
-            continue
+class _QueryGroup:
+    """
+    共享同一个唯一查询 (即同一份证据) 的三元组。
+    """
 
-        console.print(f"     - 生成的查询: {queries}")
+    def __init__(self, query: str):
+        self.query = query
+        self.snippets = None
+        self.triple_ids = []
+        self.waiting = [] # 尚未针对该证据验证的三元组
+        self.active = []  # 正在验证中的三元组
+        self.task = None
+
+class _GraphVerifier:
+    """
+    随假设三元组的到达增量地验证它们: 每个三元组到达后立即生成查询；
+    跨三元组去重后，每个唯一查询只搜索一次，共享同一证据的三元组批量验证。
+    三元组获得支持 (Supports) 或被反驳 (Refutes) 即视为已决，不再尝试其余查询；
+    取消所有已无未决三元组的分组。
+    """
+
+    def __init__(self, out: Console, on_fact=None):
+        self.triples = []
+        self.evidence = {} # {三元组ID: 支持该三元组的证据摘要}
+        self.refuted = set() # 被证据反驳、视为无法验证的三元组ID
+        self.query_index = _QueryIndex()
+        self._groups = {}
+        self._tasks = set()
+        self._semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_REQUESTS)
+        self._out = out
+        self._on_fact = on_fact
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            self._out.print(f"[bold red]验证任务出错: {task.exception()}[/bold red]")
+
+    def add_triple(self, triple: list):
+        triple_id = len(self.triples)
+        self.triples.append(triple)
+        self._spawn(self._prepare(triple_id))
+
+    def is_resolved(self, triple_id: int) -> bool:
+        return triple_id in self.evidence or triple_id in self.refuted
+
+    def facts(self, triple_ids: list) -> list:
+        return [{"triple": self.triples[triple_id], "evidence": self.evidence[triple_id]} for triple_id in triple_ids]
+
+    async def wait_done(self):
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def _prepare(self, triple_id: int):
+        triple = self.triples[triple_id]
+        queries = await agents.generate_queries(triple)
+        if not queries:
+            self._out.print(f"     - [yellow]警告: 未能为 {triple} 生成搜索查询。[/yellow]")
+            return
+        self._out.print(f"     - {triple} 生成的查询: {queries}")
 
-        is_verified = False
-        evidence_for_triple = ""
         for query in queries:
-            snippets = utils.execute_search(query)
-            verification_result = agents.verify(triple, snippets)
-            console.print(f"       - 查询 '{query}' -> 结果: [bold magenta]{verification_result}[/bold magenta]")
+            query_id = self.query_index.add(query)
+            group = self._groups.get(query_id)
+            if group is None:
+                group = self._groups[query_id] = _QueryGroup(self.query_index.queries[query_id])
+            if triple_id in group.triple_ids:
+                continue
+            group.triple_ids.append(triple_id)
+            group.waiting.append(triple_id)
+            if group.task is None or group.task.done():
+                group.task = self._spawn(self._run_group(group))
+
+    async def _run_group(self, group: _QueryGroup):
+        if group.snippets is None:
+            async with self._semaphore:
+                group.snippets = await utils.execute_search(group.query)
+
+        # 验证期间可能有新的三元组加入该分组，循环直到没有待验证的三元组
+        while True:
+            pending_ids = [triple_id for triple_id in group.waiting if not self.is_resolved(triple_id)]
+            group.waiting.clear()
+            if not pending_ids:
+                return
+            group.active = pending_ids
+            async with self._semaphore:
+                verdicts = await agents.verify_batch([self.triples[triple_id] for triple_id in pending_ids], group.snippets)
+            group.active = []
+            for triple_id, verdict in zip(pending_ids, verdicts):
+                self._out.print(f"       - {self.triples[triple_id]} | 查询 '{group.query}' -> 结果: [bold magenta]{verdict}[/bold magenta]")
+                if self.is_resolved(triple_id):
+                    continue
+                if verdict == "Supports":
+                    self._add_fact(triple_id, group.snippets)
+                elif verdict == "Refutes":
+                    self._refute(triple_id)
+
+    def _cancel_resolved_groups(self):
+        current_task = asyncio.current_task()
+        for group in self._groups.values():
+            if group.task is None or group.task.done() or group.task is current_task:
+                continue
+            if all(self.is_resolved(other_id) for other_id in group.waiting + group.active):
+                group.task.cancel()
+                # 被取消的任务要到下次唤醒时才算 done()；立即解除引用，
+                # 使 _prepare 在此期间加入的新三元组会重新启动该分组
+                group.task = None
 
-            if verification_result == "Supports":
-                is_verified = True
-                evidence_for_triple = snippets
-                verified_facts.append({"triple": triple, "evidence": evidence_for_triple})
-                break # 找到支持证据，跳出查询循环
+    def _add_fact(self, triple_id: int, snippets: str):
+        self.evidence[triple_id] = snippets
+        self._out.print(f"   - [green]✔ 已验证[/green] {self.triples[triple_id]}")
+        self._cancel_resolved_groups()
+        if self._on_fact:
+            self._on_fact()
 
-        if is_verified:
-            console.print(f"   - [green]✔ 已验证[/green] ({time.time() - start_time_triple:.2f}秒)")
-        else:
-            console.print(f"   - [red]✖ 未验证[/red] ({time.time() - start_time_triple:.2f}秒)")
+    def _refute(self, triple_id: int):
+        self.refuted.add(triple_id)
+        self._out.print(f"   - [red]✖ 被反驳[/red] {self.triples[triple_id]}")
+        self._cancel_resolved_groups()
+
+class _AnswerDraft:
+    """
+    在后台流式生成答案的起草任务。产出的文本块连同到达时间缓存下来，
+    采用该草稿时可以从头回放已生成的部分，并继续接收后续的文本块。
+    """
+
+    def __init__(self, question: str, facts: list, fact_ids: list):
+        self.fact_ids = fact_ids
+        self.chunks = [] # (文本块或 agents.ANSWER_ESCALATED, 到达时间)
+        self._updated = asyncio.Event()
+        self.task = asyncio.create_task(self._run(question, facts))
+
+    async def _run(self, question: str, facts: list):
+        try:
+            async for chunk in agents.stream_answer(question, facts):
+                self.chunks.append((chunk, time.time()))
+                self._updated.set()
+        finally:
+            self._updated.set()
+
+    def cancel(self):
+        self.task.cancel()
+
+    async def replay(self):
+        """
+        依次产出 (文本块, 到达时间)，直到起草任务结束；起草任务出错时重新抛出异常。
+        """
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.task.done():
+                self.task.result()
+                return
+            self._updated.clear()
+            await self._updated.wait()
+
+async def run_pipeline(question: str, verbose: bool = True) -> dict:
+    """
+    执行完整的“假设-验证”问答流水线。
+
+    三个阶段以推测执行的方式重叠: 假设器流式输出的每个三元组立即进入验证；
+    已验证事实达到 config.SPECULATIVE_ANSWER_MIN_FACTS 条后即开始起草答案，
+    之后每出现新的已验证事实就取消草稿并基于最新事实重新起草。
+    若验证全部结束时事实集合与草稿一致，则直接采用草稿: 回放其已生成的文本并继续流式输出。
+
+    Args:
+        question (str): 用户问题。
+        verbose (bool): 是否在控制台打印中间过程。评估框架中设为False。
+
+    Returns:
+        dict: 包含 final_answer、verified_facts、latency (秒)、time_to_first_token (秒)
+            以及 escalated (回答器是否升级到了慢速模型) 的结果。
+    """
+    out = console if verbose else _quiet_console
+    pipeline_start_time = time.time()
+    out.print(Panel(f"[bold yellow]🤔 正在处理问题: [/bold yellow]{question}", title="[bold green]开始[/bold green]", border_style="green"))
+
+    draft = None # 基于当前已验证事实的 _AnswerDraft
+
+    def redraft():
+        nonlocal draft
+        if len(verifier.evidence) < config.SPECULATIVE_ANSWER_MIN_FACTS:
+            return
+        if draft:
+            draft.cancel()
+        fact_ids = sorted(verifier.evidence)
+        draft = _AnswerDraft(question, verifier.facts(fact_ids), fact_ids)
+
+    verifier = _GraphVerifier(out, on_fact=redraft)
+
+    # --- 步骤 1: 假设 (Hypothesize) ---
+    # 查询生成、搜索与验证都是I/O密集型操作，随三元组的到达立即并发执行
+    start_time = time.time()
+    out.print("\n[bold cyan]步骤 1: 流式生成假设性知识图谱，并即时验证每个三元组...[/bold cyan]")
+    async for triple in agents.stream_graph(question):
+        out.print(f"   - [bold]生成的假设:[/bold] {triple}")
+        verifier.add_triple(triple)
+    out.print(f"   - [green]完成[/green] ({time.time() - start_time:.2f}秒)")
+
+    if not verifier.triples:
+        out.print("[bold red]无法生成假设图谱。流程终止。[/bold red]")
+        latency = time.time() - pipeline_start_time
+        return {
+            "final_answer": "无法生成假设图谱。",
+            "verified_facts": [],
+            "latency": latency,
+            "time_to_first_token": latency,
+            "escalated": False
+        }
+
+    # --- 步骤 2: 验证 (Verify) ---
+    out.print("\n[bold cyan]步骤 2: 等待剩余的验证完成...[/bold cyan]")
+    await verifier.wait_done()
+    query_index = verifier.query_index
+    out.print(f"     - 去重后共 {len(query_index.queries)} 个唯一查询 (原 {query_index.total_added} 个)")
+    for triple_id, triple in enumerate(verifier.triples):
+        if not verifier.is_resolved(triple_id):
+            out.print(f"   - [red]✖ 未验证[/red] {triple}")
+    out.print(f"   - [green]完成[/green] ({time.time() - start_time:.2f}秒)")
 
     # --- 步骤 3: 回答 (Answer) ---
+    # 流式输出答案: 用户感知的延迟从完整生成时间缩短为首个token的到达时间 (TTFT)
     start_time_answer = time.time()
-    console.print("\\n[bold cyan]步骤 3: 基于已验证的证据生成最终答案...[/bold cyan]")
-    final_answer = agents.generate_answer(question, verified_facts)
-    console.print(f"   - [green]完成[/green] ({time.time() - start_time_answer:.2f}秒)")
-
-    console.print(Panel(final_answer, title="[bold green]最终答案[/bold green]", border_style="green"))
+    out.print("\n[bold cyan]步骤 3: 基于已验证的证据生成最终答案...[/bold cyan]")
+    fact_ids = sorted(verifier.evidence)
+    verified_facts = verifier.facts(fact_ids)
+    if draft and draft.fact_ids == fact_ids:
+        out.print("   - 采用基于全部已验证事实的推测草稿")
+    else:
+        if draft:
+            draft.cancel()
+        draft = _AnswerDraft(question, verified_facts, fact_ids)
+    time_to_first_token = None
+    escalated = False
+    answer_text = Text()
+    # 静默模式下不创建 Live: 评估框架并发运行多条流水线，它们共用同一个静默控制台，
+    # 而 rich 在同一控制台上不允许 (旧版本) 或无法正确嵌套多个 Live 显示
+    live = (Live(Panel(answer_text, title="[bold green]最终答案[/bold green]", border_style="green"), console=out)
+            if verbose else contextlib.nullcontext())
+    with live:
+        # 采用草稿时，其首个文本块可能早已生成: TTFT 以文本块的到达时间为准
+        async for chunk, arrival_time in draft.replay():
+            if chunk is agents.ANSWER_ESCALATED:
+                # 快速模型的答案被撤回，改为显示慢速模型的答案；TTFT 以慢速模型的首个token为准
+                escalated = True
+                time_to_first_token = None
+                answer_text.plain = ""
+                continue
+            if time_to_first_token is None:
+                time_to_first_token = arrival_time - pipeline_start_time
+            answer_text.append(chunk)
+    final_answer = answer_text.plain.strip()
+    out.print(f"   - [green]完成[/green] ({time.time() - start_time_answer:.2f}秒)")
 
+    return {
+        "final_answer": final_answer,
+        "verified_facts": verified_facts,
+        "latency": time.time() - pipeline_start_time,
+        "time_to_first_token": time_to_first_token,
+        "escalated": escalated
+    }
 
 if __name__ == "__main__":
     # 使用实验代码中的一个问题作为示例
     test_question = "斯科特·德瑞克森和艾德·伍德的国籍相同吗？"
-    run_pipeline(test_question)
\ No newline at end of file
+    runtime.run(run_pipeline(test_question))
@@ -0,0 +1,43 @@
+# mvp/nli.py
+
+import functools
+import config
+import runtime
+
+# --- 本地NLI验证器 ---
+# 用交叉编码器 (cross-encoder) 判断 (证据摘要, 三元组) 的蕴含关系，
+# 替代只输出一个词的生成式LLM调用: 无网络往返，单次前向计算即可批量判断多个三元组
+
+# 模型标签 -> 验证器判断
+_LABEL_TO_VERDICT = {
+    "entailment": "Supports",
+    "contradiction": "Refutes",
+    "neutral": "Neutral",
+}
+
+@runtime.locked_cache
+def _nli_model():
+    # 延迟导入: 只有在第一次验证时才加载 torch 和NLI模型
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(config.NLI_VERIFIER_MODEL)
+
+@functools.cache
+def _verdict_labels() -> list:
+    # 不同NLI模型的标签顺序不同，以模型配置中的 id2label 为准
+    id2label = _nli_model().model.config.id2label
+    return [_LABEL_TO_VERDICT[id2label[i].lower()] for i in range(len(id2label))]
+
+def classify(premise: str, hypotheses: list) -> list:
+    """
+    判断证据摘要 (前提) 是否蕴含每个假设。阻塞调用，应在线程中执行。
+
+    Args:
+        premise (str): 证据摘要。
+        hypotheses (list): 假设句列表，所有假设与同一前提组成一个批次。
+
+    Returns:
+        list: 与 hypotheses 一一对应的 (判断, 置信度) 元组。
+    """
+    probabilities = _nli_model().predict([(premise, hypothesis) for hypothesis in hypotheses], apply_softmax=True)
+    labels = _verdict_labels()
+    return [(labels[int(row.argmax())], float(row.max())) for row in probabilities]
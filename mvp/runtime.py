@@ -0,0 +1,49 @@
+# mvp/runtime.py
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+# --- 运行时: 事件循环与共享线程池 ---
+
+# 进程内共享的线程池，用于嵌入计算、NLI推理等必须同步执行的阻塞操作；
+# 跨事件循环复用，避免每次运行都重新创建线程
+_EXECUTOR = ThreadPoolExecutor(max_workers=config.BLOCKING_WORKERS, thread_name_prefix="mvp")
+
+async def run_blocking(func, *args):
+    """
+    在共享线程池中执行阻塞函数，不阻塞事件循环。
+    """
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, func, *args)
+
+def locked_cache(func):
+    """
+    与 functools.cache 相同，但调用在锁内执行。functools.cache 不会对首次调用加锁，
+    共享线程池中的多个线程同时冷启动时会重复执行被装饰的函数 (如加载模型)。
+    """
+    cached = functools.cache(func)
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with lock:
+            return cached(*args, **kwargs)
+    return wrapper
+
+def run(coro):
+    """
+    运行异步入口函数: 可用时使用 uvloop 事件循环，否则回退到标准 asyncio。
+    启动前先校验配置，缺少环境变量时立即抛出 config.ConfigurationError。
+    """
+    try:
+        config.get_settings()
+    except config.ConfigurationError:
+        coro.close()
+        raise
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(coro)
+    return uvloop.run(coro)
@@ -1,65 +1,225 @@
 # mvp/utils.py
 
-import json
-import time
-import requests
-from openai import OpenAI
+import asyncio
+import functools
+import httpx
+import openai
+import orjson
+import tiktoken
+from openai import AsyncOpenAI
+from pydantic import BaseModel, ValidationError
+from rank_bm25 import BM25Okapi
+from tenacity import (retry, retry_if_exception, retry_if_exception_type, stop_after_attempt,
+                      wait_exponential, wait_exponential_jitter)
 import config
+from cache import cached_llm_call, cached_llm_stream
 
-# --- OpenAI 客户端初始化 ---
-# 使用config.py中的配置初始化一个全局客户端
-try:
-    client = OpenAI(
-        api_key=config.OPENROUTER_API_KEY,
-        base_url=config.OPENROUTER_BASE_URL
-    )
-except Exception as e:
-    print(f"初始化OpenAI客户端时出错: {e}")
-    client = None
+# --- OpenAI 客户端 ---
+
+_openai_client = None
+_openai_loop = None
+
+def get_client() -> AsyncOpenAI:
+    """
+    返回当前事件循环共享的异步客户端，缺少密钥时抛出异常。
+    客户端的连接池绑定创建它的事件循环，因此每次 runtime.run 启动新循环时重新创建。
+    """
+    global _openai_client, _openai_loop
+    loop = asyncio.get_running_loop()
+    if _openai_client is None or _openai_loop is not loop:
+        settings = config.get_settings()
+        _openai_client = AsyncOpenAI(
+            api_key=settings.openkey_api_key,
+            base_url=settings.openkey_base_url,
+            max_retries=0 # 重试由下方的 tenacity 统一处理
+        )
+        _openai_loop = loop
+    return _openai_client
+
+# --- Serper 客户端 ---
+SERPER_URL = "https://google.serper.dev/search"
+
+_serper_client = None
+_serper_loop = None
+
+def _get_serper_client() -> httpx.AsyncClient:
+    """
+    返回当前事件循环共享的Serper客户端，使所有搜索复用同一个连接池 (TCP+TLS keep-alive)。
+    """
+    global _serper_client, _serper_loop
+    loop = asyncio.get_running_loop()
+    if _serper_client is None or _serper_loop is not loop:
+        _serper_client = httpx.AsyncClient(
+            headers={
+                'X-API-KEY': config.get_settings().serper_api_key,
+                'Content-Type': 'application/json'
+            },
+            timeout=10.0,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60.0)
+        )
+        _serper_loop = loop
+    return _serper_client
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+@retry(retry=retry_if_exception(_is_retryable), stop=stop_after_attempt(3),
+       wait=wait_exponential(multiplier=0.3), reraise=True)
+async def _post_search(payload: bytes) -> dict:
+    response = await _get_serper_client().post(SERPER_URL, content=payload)
+    response.raise_for_status()
+    return orjson.loads(response.content)
 
 # --- 辅助函数 ---
 
-def call_llm(prompt: str, model: str, is_json: bool = False, system_prompt: str = None):
+# 限流 (HTTP 429)、连接错误和服务端错误时退避重试
+_RETRYABLE_LLM_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+@retry(retry=retry_if_exception_type(_RETRYABLE_LLM_ERRORS), stop=stop_after_attempt(config.LLM_MAX_ATTEMPTS),
+       wait=wait_exponential_jitter(initial=1, max=30), reraise=True)
+async def _create_chat_completion(**kwargs):
+    return await get_client().chat.completions.create(**kwargs)
+
+def _build_messages(prompt: str, system_prompt: str = None) -> list:
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+def _response_format(schema: type[BaseModel] = None, is_json: bool = False):
+    if schema is not None:
+        return {
+            "type": "json_schema",
+            "json_schema": {"name": schema.__name__, "schema": schema.model_json_schema(), "strict": True}
+        }
+    if is_json:
+        return {"type": "json_object"}
+    return None
+
+@cached_llm_call
+async def _complete(prompt: str, model: str, system_prompt: str = None, response_format: dict = None):
     """
-    一个通用的LLM调用封装函数，包含基本的重试逻辑。
+    发起一次聊天补全请求并返回文本内容 (结果经过缓存)。
+    """
+    try:
+        response = await _create_chat_completion(
+            model=model,
+            messages=_build_messages(prompt, system_prompt),
+            temperature=config.LLM_TEMPERATURE,
+            response_format=response_format or openai.NOT_GIVEN
+        )
+        return response.choices[0].message.content.strip()
+    except config.ConfigurationError:
+        raise
+    except Exception as e:
+        print(f"对模型 {model} 的LLM调用失败。错误: {e}")
+        return None
+
+async def call_llm(prompt: str, model: str, is_json: bool = False, system_prompt: str = None,
+                   schema: type[BaseModel] = None, cache_key: str = None, semantic_key: str = None,
+                   bypass_cache: bool = False):
+    """
+    一个通用的异步LLM调用封装函数，遇到限流时按指数退避重试，并经过两级响应缓存。
 
     Args:
         prompt (str): 发送给用户角色的主提示。
         model (str): 要使用的模型名称。
         is_json (bool): 是否期望返回JSON格式的输出。
         system_prompt (str, optional): 系统角色的提示。 Defaults to None.
+        schema (type[BaseModel], optional): 提供时使用Structured Outputs (严格JSON Schema)，
+            并返回校验后的模型实例。 Defaults to None.
+        cache_key (str, optional): 替代完整提示参与精确缓存匹配的键。 Defaults to None.
+        semantic_key (str, optional): 提示中的动态部分，提供时启用语义缓存。 Defaults to None.
+        bypass_cache (bool): 为True时跳过缓存。 Defaults to False.
 
     Returns:
-        str or None: LLM的响应内容，如果失败则返回None。
+        str, BaseModel or None: LLM的响应内容 (或schema实例)，如果失败则返回None。
     """
-    if not client:
-        print("错误: OpenAI客户端未初始化。")
+    content = await _complete(
+        prompt=prompt,
+        model=model,
+        system_prompt=system_prompt,
+        response_format=_response_format(schema, is_json),
+        cache_key=cache_key,
+        semantic_key=semantic_key,
+        bypass_cache=bypass_cache
+    )
+    if content is None or schema is None:
+        return content
+    try:
+        return schema.model_validate_json(content)
+    except ValidationError as e:
+        print(f"[警告] 模型 {model} 的输出不符合 {schema.__name__} 的结构: {e}")
         return None
 
-    messages = []
-    if system_prompt:
-        messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "user", "content": prompt})
+# 以 HTTP 400 拒绝 logprobs 参数的模型 (部分OpenAI兼容代理不支持)，之后的请求不再携带该参数
+_models_without_logprobs = set()
 
-    response_format = {"type": "json_object"} if is_json else None
-
-    for attempt in range(2): # 重试一次
+@cached_llm_stream
+async def _stream_complete(prompt: str, model: str, system_prompt: str = None, response_format: dict = None,
+                           token_logprobs: list = None):
+    """
+    以流式方式发起聊天补全请求，逐块产出文本 (完整结果经过缓存)。出错时直接抛出异常。
+    提供 token_logprobs 时请求logprobs，并将每个生成token的对数概率追加到该列表中；
+    服务商拒绝logprobs参数时不带该参数重试，列表保持为空。
+    """
+    request = dict(
+        model=model,
+        messages=_build_messages(prompt, system_prompt),
+        temperature=config.LLM_TEMPERATURE,
+        response_format=response_format or openai.NOT_GIVEN,
+        stream=True
+    )
+    if token_logprobs is not None and model not in _models_without_logprobs:
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=config.LLM_TEMPERATURE,
-                response_format=response_format
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"对模型 {model} 的LLM调用失败，正在重试... 错误: {e}")
-            time.sleep(1)
-    return None
+            stream = await _create_chat_completion(**request, logprobs=True)
+        except openai.BadRequestError as e:
+            print(f"[警告] 模型 {model} 拒绝了logprobs参数，改为不带logprobs重试。错误: {e}")
+            stream = await _create_chat_completion(**request)
+            _models_without_logprobs.add(model)
+    else:
+        stream = await _create_chat_completion(**request)
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        choice = chunk.choices[0]
+        if token_logprobs is not None and choice.logprobs and choice.logprobs.content:
+            token_logprobs.extend(token.logprob for token in choice.logprobs.content)
+        if choice.delta.content:
+            yield choice.delta.content
 
-def execute_search(query: str) -> str:
+async def stream_llm(prompt: str, model: str, system_prompt: str = None, schema: type[BaseModel] = None,
+                     cache_key: str = None, semantic_key: str = None, bypass_cache: bool = False,
+                     token_logprobs: list = None):
     """
-    使用Serper.dev API执行搜索查询。
+    call_llm 的流式版本: 逐块产出模型生成的原始文本，使调用方可以在生成完成前开始处理。
+    参数含义与 call_llm 相同；提供 schema 时同样启用Structured Outputs，但不做解析。
+    提供 token_logprobs 列表时收集每个token的对数概率 (随响应一并缓存)；服务商不支持logprobs时该列表为空。
+    出错时打印错误并提前结束。
+    """
+    try:
+        async for chunk in _stream_complete(
+            prompt=prompt,
+            model=model,
+            system_prompt=system_prompt,
+            response_format=_response_format(schema),
+            cache_key=cache_key,
+            semantic_key=semantic_key,
+            bypass_cache=bypass_cache,
+            token_logprobs=token_logprobs
+        ):
+            yield chunk
+    except config.ConfigurationError:
+        raise
+    except Exception as e:
+        print(f"对模型 {model} 的流式LLM调用失败。错误: {e}")
+
+async def execute_search(query: str) -> str:
+    """
+    使用Serper.dev API异步执行搜索查询。
 
     Args:
         query (str): 搜索查询字符串。
@@ -67,22 +227,60 @@ def execute_search(query: str) -> str:
     Returns:
         str: 拼接好的搜索结果摘要，或在出错时返回错误信息。
     """
-    url = "https://google.serper.dev/search"
-    payload = json.dumps({"q": query, "num": 3}) # 获取前3个结果
-    headers = {
-        'X-API-KEY': config.SERPER_API_KEY,
-        'Content-Type': 'application/json'
-    }
+    payload = orjson.dumps({"q": query, "num": 3}) # 获取前3个结果
 
     try:
-        response = requests.post(url, headers=headers, data=payload)
-        response.raise_for_status()
-        results = response.json()
+        results = await _post_search(payload)
         snippets = [res.get("snippet", "") for res in results.get("organic", [])]
-        return "\\n".join(filter(None, snippets))
-    except requests.exceptions.RequestException as e:
-        print(f"\\n[错误] Serper API调用失败: {e}")
+        return "\n".join(filter(None, snippets))
+    except httpx.HTTPError as e:
+        print(f"\n[错误] Serper API调用失败: {e}")
+        return "SEARCH_API_ERROR"
+    except orjson.JSONDecodeError:
+        print(f"\n[错误] 解码来自Serper的JSON响应失败。")
         return "SEARCH_API_ERROR"
-    except json.JSONDecodeError:
-        print(f"\\n[错误] 解码来自Serper的JSON响应失败。")
-        return "SEARCH_API_ERROR"
\ No newline at end of file
+
+# --- Token预算 ---
+
+@functools.cache
+def _tokenizer() -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(config.TOKENIZER_MODEL)
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    将文本截断到最多 max_tokens 个token。
+    """
+    tokens = _tokenizer().encode(text)
+    return text if len(tokens) <= max_tokens else _tokenizer().decode(tokens[:max_tokens])
+
+def select_evidence(question: str, facts: list, max_tokens: int) -> list:
+    """
+    在token预算内挑选与问题最相关的已验证事实。
+
+    以token ID为词项计算问题与每条证据的BM25得分，按得分从高到低贪心装入预算；
+    装不下的事实被跳过。返回的事实保持原有顺序。
+
+    Args:
+        question (str): 用户问题。
+        facts (list): 形如 {"triple": ..., "evidence": ...} 的已验证事实。
+        max_tokens (int): 事实与证据的总token预算。
+
+    Returns:
+        list: 预算内的事实子集。
+    """
+    encoder = _tokenizer()
+    fact_tokens = [encoder.encode(f"{fact['triple']} {fact['evidence']}") for fact in facts]
+    if sum(len(tokens) for tokens in fact_tokens) <= max_tokens:
+        return facts
+
+    scores = BM25Okapi(fact_tokens).get_scores(encoder.encode(question))
+    selected, used = set(), 0
+    for i in sorted(range(len(facts)), key=lambda i: scores[i], reverse=True):
+        if used + len(fact_tokens[i]) <= max_tokens:
+            selected.add(i)
+            used += len(fact_tokens[i])
+    if not selected:
+        # 连最相关的一条都放不下时，截断它的证据
+        best = int(scores.argmax())
+        return [{**facts[best], "evidence": truncate_tokens(facts[best]["evidence"], max_tokens)}]
+    return [fact for i, fact in enumerate(facts) if i in selected]
@@ -1,22 +1,65 @@
-import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import orjson
 from datasets import load_dataset
-from tqdm import tqdm
 import pathlib
-import random
-import os
 
 # --- Configuration ---
 SEED = 42
 DISTRACTOR_DOCS_COUNT = 20000
 CORPUS_OUTPUT_FILENAME = "./data/hotpotqa_corpus.jsonl"
+CORPUS_PARQUET_OUTPUT_FILENAME = "./data/hotpotqa_corpus.parquet" # Columnar copy for fast loading in script 02
 TEST_SET_OUTPUT_FILENAME = "./data/hotpotqa_test_set.jsonl"
-NUM_PROCESSORS = os.cpu_count() or 1
+TITLE_BATCH_SIZE = 65536 # Rows per Arrow batch when scanning the Wikipedia corpus
 
 # --- Setup ---
-random.seed(SEED)
+rng = np.random.default_rng(SEED)
 
-def normalize_title(title: str) -> str:
-    return title.strip().lower()
+def normalize_titles(titles):
+    """Normalizes an Arrow array of titles for matching (trim whitespace + lowercase)."""
+    return pc.utf8_lower(pc.utf8_trim_whitespace(titles))
+
+def iter_normalized_titles(dataset, batch_size=TITLE_BATCH_SIZE):
+    """
+    Yields (Arrow batch, normalized titles) for consecutive batches of a dataset's memory-mapped Arrow table,
+    so only one batch of rows is resident at a time.
+    """
+    for batch in dataset.data.to_batches(max_chunksize=batch_size):
+        yield batch, normalize_titles(batch.column('title'))
+
+def reservoir_sample(reservoir, seen, candidates):
+    """
+    Vectorized reservoir sampling (Algorithm R): offers a table of candidate rows to a fixed-size reservoir
+    ({column name: object array}) that has already been offered `seen` rows. Returns the updated count.
+    """
+    k = len(next(iter(reservoir.values())))
+    positions = seen + np.arange(candidates.num_rows)
+    # Row i replaces a uniformly drawn slot j <= i when j falls inside the reservoir;
+    # the first k rows fill the reservoir directly.
+    slots = np.where(positions < k, positions, rng.integers(0, positions + 1))
+    accepted = np.flatnonzero(slots < k)
+    # Later rows win collisions, as in the sequential algorithm. Fancy-index assignment leaves the winner of
+    # repeated indices unspecified, so keep only the last accepted row per slot (first one in reversed order).
+    winning_slots, last_from_end = np.unique(slots[accepted][::-1], return_index=True)
+    winners = accepted[len(accepted) - 1 - last_from_end]
+    # Only winning rows are converted to Python objects
+    winning_rows = candidates.take(pa.array(winners))
+    for name, column in reservoir.items():
+        column[winning_slots] = winning_rows.column(name).to_numpy(zero_copy_only=False)
+    return seen + candidates.num_rows
+
+def reservoir_table(reservoir, seen, schema):
+    """Converts the filled part of a reservoir back into an Arrow table with the given schema."""
+    size = min(seen, len(next(iter(reservoir.values()))))
+    return pa.table({name: pa.array(reservoir[name][:size], type=schema.field(name).type) for name in schema.names}, schema=schema)
+
+def write_jsonl(table: pa.Table, path: str, batch_size=TITLE_BATCH_SIZE):
+    """Writes an Arrow table as JSON Lines with orjson, batch by batch, without a pandas round trip."""
+    with open(path, 'wb') as f:
+        for batch in table.to_batches(max_chunksize=batch_size):
+            f.writelines(orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE) for record in batch.to_pylist())
 
 if __name__ == '__main__':
     # --- Step 1: Get Required Document Titles from HotpotQA ---
@@ -24,55 +67,60 @@ if __name__ == '__main__':
     hotpotqa_validation_split = load_dataset("hotpot_qa", "fullwiki", trust_remote_code=True)['validation']
     
     print("Extracting and normalizing unique supporting document titles...")
-    required_titles_normalized = set()
-    for item in tqdm(hotpotqa_validation_split, desc="Scanning HotpotQA"):
-        for title in item['supporting_facts']['title']:
-            required_titles_normalized.add(normalize_title(title))
+    # OPTIMIZATION: Flatten and normalize the supporting-fact titles in Arrow instead of a per-item Python loop.
+    supporting_titles = pc.list_flatten(pc.struct_field(hotpotqa_validation_split.data.column('supporting_facts'), 'title'))
+    required_titles_normalized = set(pc.unique(normalize_titles(supporting_titles)).to_pylist())
 
-    # --- Step 2: Select Distractor Documents ---
+    # --- Step 2: Select Required and Distractor Documents in One Pass ---
     print("\nLoading Wikipedia corpus...")
-    wiki_corpus = load_dataset("wikimedia/wikipedia", "20231101.en", trust_remote_code=True)['train']
-    
-    print("Normalizing all Wikipedia titles to create the distractor pool...")
-    all_wiki_titles_normalized = {normalize_title(title) for title in tqdm(wiki_corpus['title'], desc="Normalizing Wiki Titles")}
+    # OPTIMIZATION: Scan the memory-mapped Arrow cache in bounded batches instead of materializing all ~6M
+    # articles. The local download is shared with script 03 and reused across runs, unlike a streaming load.
+    wiki_corpus = load_dataset("wikimedia/wikipedia", "20231101.en", split='train')
     
-    distractor_pool = list(all_wiki_titles_normalized - required_titles_normalized)
-    
-    print(f"Randomly selecting {DISTRACTOR_DOCS_COUNT:,} distractor articles...")
-    distractor_titles_normalized = set(random.sample(distractor_pool, DISTRACTOR_DOCS_COUNT))
-    
-    final_corpus_titles_normalized = required_titles_normalized.union(distractor_titles_normalized)
+    print(f"Collecting required articles and reservoir-sampling {DISTRACTOR_DOCS_COUNT:,} distractor articles...")
+    # OPTIMIZATION: A single pass partitions every batch into required rows (an Arrow set-membership test
+    # against the normalized titles) and distractor candidates offered to a fixed-size reservoir. This replaces
+    # building the set of all Wikipedia titles, sampling from it and filtering the corpus again, and keeps
+    # memory at O(required + DISTRACTOR_DOCS_COUNT) rows.
+    required_value_set = pa.array(list(required_titles_normalized))
+    required_batches = []
+    distractor_reservoir = None
+    seen = 0
+    for batch, titles_normalized in iter_normalized_titles(wiki_corpus):
+        if distractor_reservoir is None:
+            corpus_schema = batch.schema
+            distractor_reservoir = {name: np.empty(DISTRACTOR_DOCS_COUNT, dtype=object) for name in corpus_schema.names}
+        is_required = pc.is_in(titles_normalized, value_set=required_value_set)
+        required_batches.append(batch.filter(is_required))
+        seen = reservoir_sample(distractor_reservoir, seen, batch.filter(pc.invert(is_required)))
+    distractor_table = reservoir_table(distractor_reservoir, seen, corpus_schema)
 
-    # --- Step 3: Build and Save the Document Corpus ---
-    print(f"\nBuilding the final corpus by filtering the dataset (using {NUM_PROCESSORS} processes)...")
-    
-    def is_in_final_corpus(example):
-        return normalize_title(example['title']) in final_corpus_titles_normalized
-
-    filtered_corpus_dataset = wiki_corpus.filter(is_in_final_corpus, num_proc=NUM_PROCESSORS)
-    
-    corpus_df = filtered_corpus_dataset.to_pandas()
+    # --- Step 3: Save the Document Corpus ---
+    print("\nSaving the document corpus...")
+    corpus_table = pa.concat_tables([pa.Table.from_batches(required_batches, schema=corpus_schema), distractor_table])
     
+    # OPTIMIZATION: Write both files straight from Arrow, skipping the Arrow -> pandas copy.
     pathlib.Path(CORPUS_OUTPUT_FILENAME).parent.mkdir(parents=True, exist_ok=True)
-    corpus_df.to_json(CORPUS_OUTPUT_FILENAME, orient='records', lines=True, force_ascii=False)
+    write_jsonl(corpus_table, CORPUS_OUTPUT_FILENAME)
+    pq.write_table(corpus_table, CORPUS_PARQUET_OUTPUT_FILENAME, compression='zstd')
 
     # --- Step 4: Save the Corresponding HotpotQA Test Set ---
     # Since our corpus is guaranteed to contain all documents needed for the validation set,
     # we can save the entire validation set as our corresponding test file.
     print(f"\nSaving the full HotpotQA validation set as the test set...")
-    test_set_df = hotpotqa_validation_split.to_pandas()
-    test_set_df.to_json(TEST_SET_OUTPUT_FILENAME, orient='records', lines=True, force_ascii=False)
+    write_jsonl(hotpotqa_validation_split.data.table, TEST_SET_OUTPUT_FILENAME)
     
     # --- Step 5: Print Metadata Summary ---
     print("\n" + "="*50)
     print("              Data Generation Complete")
     print("="*50)
     print("\n--- Metadata Summary ---")
-    print(f"Total Articles in Corpus:   {len(corpus_df):,}")
+    print(f"Total Articles in Corpus:   {corpus_table.num_rows:,}")
     print(f"  - Required Articles:      {len(required_titles_normalized):,}")
-    print(f"  - Distractor Articles:    {len(distractor_titles_normalized):,}")
-    print(f"Total Questions in Test Set: {len(test_set_df):,}")
+    print(f"  - Distractor Articles:    {distractor_table.num_rows:,}")
+    print(f"Total Questions in Test Set: {hotpotqa_validation_split.num_rows:,}")
     print("-" * 28)
     print(f"Corpus saved to:            '{CORPUS_OUTPUT_FILENAME}'")
+    print(f"                            '{CORPUS_PARQUET_OUTPUT_FILENAME}'")
     print(f"Test Set saved to:          '{TEST_SET_OUTPUT_FILENAME}'")
     print("="*50)
\ No newline at end of file
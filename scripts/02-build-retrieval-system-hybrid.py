@@ -1,30 +1,193 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 import torch
 import os
-import pickle # B_NEW: For saving and loading the BM25 retriever
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+import bm25s
 
 # LangChain core components
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
 from langchain_core.documents import Document
-from langchain.retrievers import BM25Retriever, EnsembleRetriever
+from langchain_core.retrievers import BaseRetriever
+from langchain.retrievers import EnsembleRetriever
 from langchain.retrievers.document_compressors import FlashrankRerank
 from langchain.retrievers import ContextualCompressionRetriever
 
 # Supporting LangChain components
 from langchain_community.vectorstores import Chroma
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 
 # ------------------- Configuration -------------------
 CORPUS_FILE = "./data/hotpotqa_corpus.jsonl"
+CORPUS_PARQUET_FILE = "./data/hotpotqa_corpus.parquet" # Written by script 01; preferred over the JSONL copy
 TEST_SET_FILE = "./data/hotpotqa_test_set.jsonl"
 # EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 RERANKER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
 CHROMA_DB_PATH = "./data/chroma_db_hotpotqa_lc"
 COLLECTION_NAME = "hotpotqa_corpus_lc"
-BM25_INDEX_PATH = "./data/bm25_retriever.pkl" # B_NEW: Path to save the serialized BM25 index
+BM25_INDEX_PATH = "./data/bm25_index" # B_NEW: Directory holding the serialized BM25 index (numpy arrays + chunk table)
+BM25_DOCS_FILENAME = "documents.parquet"
+CHUNK_CACHE_FILE = "./data/hotpotqa_chunks_embedded.parquet" # Split chunks + embeddings, reused when rebuilding Chroma
+CHUNK_SIZE = 512 # Characters per chunk
+CHUNK_OVERLAP = 20 # Characters shared by consecutive chunks
+EMBEDDING_BATCH_SIZE = 512 # Sentence-transformers encode batch size on the GPU
+EMBED_BLOCK_SIZE = 8192 # Chunks embedded per embed_documents call (bounds host memory for the vectors)
+CHROMA_ADD_BATCH_SIZE = 1000 # Records per Chroma collection.add call
+MAX_PENDING_WRITES = 2 # Embedded blocks allowed to queue behind the Chroma writer thread
+CHROMA_GET_PAGE_SIZE = 10000 # Records per collection.get page when reading the store back for BM25
+
+# HNSW settings for a newly built collection: flush the index to disk every 100k inserts (instead of every 1k)
+# and apply queued inserts to the graph in batches of 10k. batch_size must not exceed sync_threshold.
+HNSW_COLLECTION_METADATA = {"hnsw:sync_threshold": 100000, "hnsw:batch_size": 10000, "hnsw:construction_ef": 200}
+
+# ------------------- Helper Functions -------------------
+
+def fast_split(text, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """
+    Splits text into fixed-size character windows overlapping by `overlap` characters. The last window
+    always reaches the end of the text, and no window lies entirely inside the previous one's overlap.
+    """
+    if not text:
+        return []
+    return [text[start:start + size] for start in range(0, max(len(text) - overlap, 1), size - overlap)]
+
+def chunker_id():
+    # Recorded in the chunk cache so a change to the chunking parameters invalidates it
+    return f"fixed-{CHUNK_SIZE}-{CHUNK_OVERLAP}"
+
+def corpus_source():
+    """The corpus file chunks are built from: the Parquet copy written by script 01 when present, else the JSONL."""
+    return CORPUS_PARQUET_FILE if os.path.exists(CORPUS_PARQUET_FILE) else CORPUS_FILE
+
+def corpus_fingerprint():
+    # Recorded in the chunk cache so re-running script 01 (a new corpus) invalidates it
+    path = corpus_source()
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}-{stat.st_size}-{stat.st_mtime_ns}"
+
+def chunk_cache_metadata():
+    """Everything the cached chunks and embeddings depend on, stored in the cache's schema metadata."""
+    return {'embedding_model': EMBEDDING_MODEL, 'chunker': chunker_id(), 'corpus': corpus_fingerprint()}
+
+def add_block(collection, first_id, texts, titles, embeddings):
+    """Writes one embedded block to the Chroma collection in CHROMA_ADD_BATCH_SIZE batches."""
+    for offset in range(0, len(texts), CHROMA_ADD_BATCH_SIZE):
+        batch_texts = texts[offset:offset + CHROMA_ADD_BATCH_SIZE]
+        collection.add(
+            ids=[str(i) for i in range(first_id + offset, first_id + offset + len(batch_texts))],
+            embeddings=embeddings[offset:offset + CHROMA_ADD_BATCH_SIZE],
+            documents=batch_texts,
+            metadatas=[{"title": title} for title in titles[offset:offset + CHROMA_ADD_BATCH_SIZE]]
+        )
+
+def iter_collection_documents(collection, page_size=CHROMA_GET_PAGE_SIZE):
+    """Yields the collection's chunks as LangChain Documents, reading it page by page."""
+    offset = 0
+    while True:
+        page = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+        if not page['documents']:
+            return
+        for text, metadata in zip(page['documents'], page['metadatas']):
+            yield Document(page_content=text, metadata=metadata)
+        offset += len(page['documents'])
+
+def embed_chunks(embedding_function, texts, titles):
+    """
+    Embeds the chunks block by block, yielding (texts, titles, embeddings) for each block
+    while appending it to the chunk cache. The cache only appears once every block is written.
+    """
+    tmp_path = CHUNK_CACHE_FILE + ".tmp"
+    writer = None
+    for start in range(0, len(texts), EMBED_BLOCK_SIZE):
+        block_texts = texts[start:start + EMBED_BLOCK_SIZE]
+        block_titles = titles[start:start + EMBED_BLOCK_SIZE]
+        block_embeddings = np.asarray(embedding_function.embed_documents(block_texts), dtype=np.float32)
+        block = pa.table({
+            'text': block_texts,
+            'title': block_titles,
+            'embedding': pa.FixedSizeListArray.from_arrays(block_embeddings.ravel(), block_embeddings.shape[1])
+        })
+        if writer is None:
+            schema = block.schema.with_metadata(chunk_cache_metadata())
+            writer = pq.ParquetWriter(tmp_path, schema, compression='zstd')
+        writer.write_table(block.cast(writer.schema))
+        yield block_texts, block_titles, block_embeddings
+    if writer is not None:
+        writer.close()
+        os.replace(tmp_path, CHUNK_CACHE_FILE)
+
+def load_cached_chunks():
+    """
+    Returns (number of chunks, iterator of (texts, titles, embeddings) blocks) read from the chunk cache,
+    or None if there is no cache or it was built from a different corpus, embedding model or chunker.
+    """
+    if not os.path.exists(CHUNK_CACHE_FILE):
+        return None
+    cache = pq.ParquetFile(CHUNK_CACHE_FILE)
+    cache_metadata = cache.schema_arrow.metadata or {}
+    stale = [key for key, value in chunk_cache_metadata().items() if cache_metadata.get(key.encode()) != value.encode()]
+    if stale:
+        print(f"Chunk cache {CHUNK_CACHE_FILE} is stale (changed: {', '.join(stale)}); ignoring it.")
+        return None
+
+    def blocks():
+        for batch in cache.iter_batches(batch_size=EMBED_BLOCK_SIZE):
+            embeddings = batch.column('embedding')
+            yield (
+                batch.column('text').to_pylist(),
+                batch.column('title').to_pylist(),
+                embeddings.flatten().to_numpy().reshape(len(batch), embeddings.type.list_size)
+            )
+    return cache.metadata.num_rows, blocks()
+
+class BM25SRetriever(BaseRetriever):
+    """
+    LangChain retriever over a bm25s index: scores are computed with sparse numpy
+    operations instead of rank_bm25's per-document Python loop.
+    """
+    index: Any
+    docs: list[Document]
+    k: int = 10
+
+    @classmethod
+    def from_documents(cls, documents, k=10):
+        documents = list(documents)
+        index = bm25s.BM25()
+        index.index(bm25s.tokenize([doc.page_content for doc in documents], stopwords="en"))
+        return cls(index=index, docs=documents, k=k)
+
+    def save(self, path):
+        """Saves the index as bm25s' numpy arrays and the chunks as a Parquet table, instead of pickling the object graph."""
+        self.index.save(path)
+        pq.write_table(pa.table({
+            'text': [doc.page_content for doc in self.docs],
+            'title': [doc.metadata.get("title") for doc in self.docs]
+        }), os.path.join(path, BM25_DOCS_FILENAME), compression='zstd')
+
+    @classmethod
+    def load(cls, path, k=10):
+        # The score matrix is memory-mapped, so loading doesn't copy it into RAM
+        index = bm25s.BM25.load(path, mmap=True)
+        table = pq.read_table(os.path.join(path, BM25_DOCS_FILENAME))
+        docs = [
+            Document(page_content=text, metadata={"title": title})
+            for text, title in zip(table.column('text').to_pylist(), table.column('title').to_pylist())
+        ]
+        return cls(index=index, docs=docs, k=k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        query_tokens = bm25s.tokenize(query, stopwords="en", show_progress=False)
+        doc_ids, _ = self.index.retrieve(query_tokens, k=min(self.k, len(self.docs)), show_progress=False)
+        return [self.docs[i] for i in doc_ids[0]]
 
 # ------------------- Main Flow -------------------
 
@@ -35,9 +198,15 @@ if __name__ == '__main__':
     if device == "cpu":
         print("Warning: CUDA not available, falling back to CPU. This will be very slow.")
 
+    # OPTIMIZATION: Run the encoder in fp16 on the GPU, halving memory traffic and using the tensor cores.
+    model_kwargs = {'device': device}
+    if device == "cuda":
+        model_kwargs['model_kwargs'] = {'torch_dtype': torch.float16}
     embedding_function = HuggingFaceEmbeddings(
         model_name=EMBEDDING_MODEL,
-        model_kwargs={'device': device}
+        model_kwargs=model_kwargs,
+        # Unit-length vectors make Chroma's default L2 distance rank by cosine similarity
+        encode_kwargs={'batch_size': EMBEDDING_BATCH_SIZE, 'normalize_embeddings': True}
     )
 
     # --- Setup ChromaDB and Load or Build the Index ---
@@ -50,33 +219,64 @@ if __name__ == '__main__':
             collection_name=COLLECTION_NAME
         )
     else:
-        print(f"No index found. Building new index from: {CORPUS_FILE}")
-        corpus_df = pd.read_json(CORPUS_FILE, lines=True)
-        documents = [
-            Document(page_content=row['text'], metadata={"title": row['title']})
-            for _, row in tqdm(corpus_df.iterrows(), total=len(corpus_df), desc="Creating LangChain Documents")
-        ]
-        
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=512, chunk_overlap=20)
-        chunked_documents = text_splitter.split_documents(documents)
+        # OPTIMIZATION: Reuse the split chunks and their embeddings from a previous build when available,
+        # skipping both the splitter and the encoder pass.
+        cached_chunks = load_cached_chunks()
+        if cached_chunks is not None:
+            print(f"No index found. Loading chunks and embeddings from cache: {CHUNK_CACHE_FILE}")
+            num_chunks, chunk_blocks = cached_chunks
+        else:
+            # OPTIMIZATION: Read the columnar Parquet corpus when available instead of parsing JSONL text.
+            if corpus_source() == CORPUS_PARQUET_FILE:
+                print(f"No index found. Building new index from: {CORPUS_PARQUET_FILE}")
+                corpus_df = pd.read_parquet(CORPUS_PARQUET_FILE, engine='pyarrow', columns=['title', 'text'])
+            else:
+                print(f"No index found. Building new index from: {CORPUS_FILE}")
+                corpus_df = pd.read_json(CORPUS_FILE, lines=True)
+            # OPTIMIZATION: Extract the columns once and zip them instead of boxing every row with iterrows().
+            texts = corpus_df['text'].tolist()
+            titles = corpus_df['title'].tolist()
+            
+            # OPTIMIZATION: Fixed-size character windows replace RecursiveCharacterTextSplitter's recursive
+            # per-separator regex splits, and chunks go straight to the encoder without LangChain Documents.
+            chunk_texts, chunk_titles = [], []
+            for text, title in tqdm(zip(texts, titles), total=len(corpus_df), desc="Splitting documents"):
+                chunks = fast_split(text)
+                chunk_texts.extend(chunks)
+                chunk_titles.extend([title] * len(chunks))
+            num_chunks = len(chunk_texts)
+            chunk_blocks = embed_chunks(embedding_function, chunk_texts, chunk_titles)
 
         print("Building new index and storing in ChromaDB (this will take a while)...")
         
         # Initialize an empty Chroma vector store first
+        # OPTIMIZATION: Larger HNSW write epochs amortize index flushes across many more inserts.
         vectorstore = Chroma(
             persist_directory=CHROMA_DB_PATH,
             embedding_function=embedding_function,
-            collection_name=COLLECTION_NAME
+            collection_name=COLLECTION_NAME,
+            collection_metadata=HNSW_COLLECTION_METADATA
         )
         
-        # Add documents in batches with a progress bar
-        batch_size = 256 # You can tune this batch size
-        for i in tqdm(range(0, len(chunked_documents), batch_size), desc="Adding documents to Chroma"):
-            batch = chunked_documents[i:i + batch_size]
-            vectorstore.add_documents(documents=batch)
-        
-        # Persist the database to disk after adding all documents
-        vectorstore.persist()
+        # OPTIMIZATION: Embed large blocks of chunks in one GPU-batched pass each, then write them to the
+        # underlying Chroma collection with precomputed embeddings, bypassing add_documents' per-batch overhead.
+        # A single writer thread commits each block while the next one is being embedded, hiding SQLite/HNSW
+        # write latency behind the encoder (the persistent store only allows one writer).
+        next_id = 0
+        with tqdm(total=num_chunks, desc="Embedding and adding documents to Chroma") as progress, \
+                ThreadPoolExecutor(max_workers=1, thread_name_prefix="chroma-writer") as writer:
+            pending_writes = deque()
+            for block_texts, block_titles, block_embeddings in chunk_blocks:
+                write = writer.submit(add_block, vectorstore._collection, next_id, block_texts, block_titles, block_embeddings)
+                write.add_done_callback(lambda _, n=len(block_texts): progress.update(n))
+                pending_writes.append(write)
+                next_id += len(block_texts)
+                # Bound the embedded blocks held in memory; result() also re-raises write errors
+                while len(pending_writes) > MAX_PENDING_WRITES:
+                    pending_writes.popleft().result()
+            for write in pending_writes:
+                write.result()
+        # No persist() call: chromadb >= 0.4 writes to disk automatically, so it was a no-op.
     
     print(f"Index ready. Total documents in store: {vectorstore._collection.count()}")
     
@@ -91,20 +291,17 @@ if __name__ == '__main__':
     bm25_retriever = None
     if os.path.exists(BM25_INDEX_PATH):
         print(f"Loading existing BM25 index from: {BM25_INDEX_PATH}")
-        with open(BM25_INDEX_PATH, "rb") as f:
-            bm25_retriever = pickle.load(f)
+        bm25_retriever = BM25SRetriever.load(BM25_INDEX_PATH, k=10)
     else:
         print("No BM25 index found. Building new one...")
-        # OPTIMIZATION: Call vectorstore.get() only once.
-        vs_data = vectorstore.get(include=["metadatas", "documents"])
-        all_docs = vs_data['documents']
-        all_metadatas = vs_data['metadatas']
-        doc_list = [Document(page_content=doc, metadata=meta) for doc, meta in zip(all_docs, all_metadatas)]
+        # OPTIMIZATION: Page through the collection, turning each page into Documents as it arrives,
+        # instead of pulling every text and metadata into Python lists with one vectorstore.get().
+        doc_list = iter_collection_documents(vectorstore._collection)
         
-        bm25_retriever = BM25Retriever.from_documents(doc_list, k=10)
+        # OPTIMIZATION: bm25s builds a sparse score matrix with numpy, far faster than rank_bm25 for build and query.
+        bm25_retriever = BM25SRetriever.from_documents(doc_list, k=10)
         print(f"Saving BM25 index to: {BM25_INDEX_PATH}")
-        with open(BM25_INDEX_PATH, "wb") as f:
-            pickle.dump(bm25_retriever, f)
+        bm25_retriever.save(BM25_INDEX_PATH)
 
     # 3. Ensemble Retriever for Hybrid Search
     ensemble_retriever = EnsembleRetriever(
@@ -1,19 +1,34 @@
 # First, ensure the necessary libraries are installed
-# pip install openai pandas datasets tqdm nltk
+# pip install openai pandas datasets nltk tenacity
 
+import asyncio
+import atexit
+import bisect
+import dbm
+import functools
+import hashlib
 import json
+import pickle
 import random
-from openai import OpenAI
+import zlib
+import openai
+import pyarrow.compute as pc
+from openai import AsyncOpenAI
 from datasets import load_dataset
-from tqdm import tqdm
 import pandas as pd
 import nltk
+from nltk.tokenize.punkt import PunktTokenizer
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 
 # ------------------- Configuration -------------------
 # To run, ensure your OpenAI API key is set as an environment variable
 # e.g., export OPENAI_API_KEY='your_key_here'
-client = OpenAI() 
+client = AsyncOpenAI(max_retries=0) # Retries are handled by tenacity below
 CONTRADICTION_MODEL = "gpt-4o" # Using a powerful model is best for this task
+# OPTIMIZATION: The workload is bound by HTTP round trips, so keep many requests in flight.
+MAX_CONCURRENT_REQUESTS = 32
+# OPTIMIZATION: Persist LLM responses on disk so re-runs and parameter sweeps don't pay for them again.
+LLM_CACHE_FILE = "./data/llm_cache.dbm"
 STANDARD_TEST_SET_FILE = "./data/test_set_standard.jsonl" # Adjusted path
 WIKI_CORPUS_NAME = "wikimedia/wikipedia"
 WIKI_CORPUS_VERSION = "20231101.en"
@@ -54,61 +69,99 @@ Contradictory Fact with Fictional Citation:
 
 # ------------------- Core Functions -------------------
 
-def call_llm(prompt, model, temperature=0.7):
-    """A robust wrapper for making LLM calls."""
-    try:
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
-            max_tokens=100
-        )
-        content = response.choices[0].message.content
-        if content:
-            # Clean up common artifacts from LLM responses
-            return content.strip().replace('"', '')
-        return None
-    except Exception as e:
-        print(f"LLM call failed: {e}")
+# OPTIMIZATION: Back off exponentially on rate limits (HTTP 429) instead of dropping the sample.
+@retry(retry=retry_if_exception_type(openai.RateLimitError), wait=wait_exponential(multiplier=1, max=60),
+       stop=stop_after_attempt(6), reraise=True)
+async def _create_completion(**kwargs):
+    return await client.chat.completions.create(**kwargs)
+
+@functools.cache
+def _llm_cache():
+    db = dbm.open(LLM_CACHE_FILE, 'c')
+    atexit.register(db.close)
+    return db
+
+def _cache_key(model, prompt, temperature):
+    return hashlib.sha256(pickle.dumps((model, prompt, temperature))).digest()
+
+async def acall_llm(prompt, sem, model=CONTRADICTION_MODEL, temperature=0.7):
+    """
+    A robust async wrapper for making LLM calls, bounded by the given semaphore.
+    Successful responses are cached on disk, keyed by SHA256 of (model, prompt, temperature).
+    """
+    db = _llm_cache()
+    key = _cache_key(model, prompt, temperature)
+    cached = db.get(key)
+    if cached is not None:
+        return pickle.loads(zlib.decompress(cached))
+
+    async with sem:
+        try:
+            response = await _create_completion(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=temperature,
+                max_tokens=100
+            )
+        except Exception as e:
+            print(f"LLM call failed: {e}")
+            return None
+    content = response.choices[0].message.content
+    if not content:
         return None
+    # Clean up common artifacts from LLM responses
+    content = content.strip().replace('"', '')
+    db[key] = zlib.compress(pickle.dumps(content))
+    return content
 
 class ContradictionAgent:
     def __init__(self, model=CONTRADICTION_MODEL):
         self.model = model
 
-    def create_contradiction(self, sentence, level=1, add_fake_source=False):
-        """Generates a contradictory sentence based on the specified level and options."""
+    def build_prompt(self, sentence, level=1, add_fake_source=False):
+        """Returns the (prompt, temperature) pair for the specified level and options."""
         # Use the optimized, combined prompt when possible
         if level == 2 and add_fake_source:
-            prompt = CONTRADICTION_PROMPT_L2_WITH_SOURCE.format(sentence=sentence)
-            return call_llm(prompt, self.model, temperature=0.9)
+            return CONTRADICTION_PROMPT_L2_WITH_SOURCE.format(sentence=sentence), 0.9
 
         # Otherwise, follow the original logic
+        # Note: For L1, adding a source would still require a second call.
+        # FAKE_SOURCE_PROMPT would be needed here if you wanted to support this.
         if level == 1:
-            prompt = CONTRADICTION_PROMPT_L1.format(sentence=sentence)
-        else: # level 2
-            prompt = CONTRADICTION_PROMPT_L2.format(sentence=sentence)
-            
-        contradictory_sentence = call_llm(prompt, self.model)
-        
-        # This part is now only needed for Level 1 with a fake source
-        if contradictory_sentence and add_fake_source and level == 1:
-            # Note: For L1, adding a source still requires a second call.
-            # To combine them, you would need another specific prompt.
-            # FAKE_SOURCE_PROMPT would be needed here if you wanted to support this.
-            pass
+            return CONTRADICTION_PROMPT_L1.format(sentence=sentence), 0.7
+        return CONTRADICTION_PROMPT_L2.format(sentence=sentence), 0.7
 
-        return contradictory_sentence
+    async def create_contradiction(self, sentence, sem, level=1, add_fake_source=False):
+        """Generates a contradictory sentence based on the specified level and options."""
+        prompt, temperature = self.build_prompt(sentence, level, add_fake_source)
+        return await acall_llm(prompt, sem, self.model, temperature)
+
+async def batch_contradict(sentences, level=1, add_fake_source=False, agent=None):
+    """
+    Generates contradictions for many sentences concurrently.
+    Results are returned in the same order as the input sentences (None for failed calls).
+    """
+    agent = agent or ContradictionAgent()
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return await asyncio.gather(*(
+        agent.create_contradiction(sentence, sem, level, add_fake_source) for sentence in sentences
+    ))
 
 # --- IMPROVEMENT 1: RELIABLE SENTENCE SPLITTING ---
+# NLTK >= 3.9 loads Punkt from the pickle-free 'punkt_tab' data (downloaded in the main flow if missing);
+# this is the same tokenizer nltk.sent_tokenize uses, created once and reused.
+@functools.cache
+def sentence_tokenizer():
+    return PunktTokenizer("english")
+
 def find_meaningful_sentence(wiki_article):
     """
     Uses NLTK to safely tokenize sentences and find a suitable one.
     """
     if not wiki_article or 'text' not in wiki_article:
         return None
-    # Use nltk's recommended sentence tokenizer
-    sentences = nltk.sent_tokenize(wiki_article['text'])
+    # Use nltk's recommended (Punkt) sentence tokenizer
+    sentences = sentence_tokenizer().tokenize(wiki_article['text'])
     # Filter for sentences that are likely to contain a complete fact
     meaningful_sentences = [s.strip() for s in sentences if 15 < len(s.split()) < 100]
     
@@ -117,15 +170,47 @@ def find_meaningful_sentence(wiki_article):
     
     return random.choice(meaningful_sentences)
 
+class TitleIndex:
+    """
+    Title -> row lookups by binary search over the Arrow title column sorted in native code,
+    so no Python object is created per article.
+    """
+    def __init__(self, titles):
+        self._order = pc.array_sort_indices(titles)
+        self._sorted_titles = titles.take(self._order).combine_chunks()
+
+    def __len__(self):
+        return len(self._sorted_titles)
+
+    def __getitem__(self, i):
+        return self._sorted_titles[i].as_py()
+
+    def get(self, title):
+        """Returns the row index of an article with this exact title, or None."""
+        # Arrow sorts strings by UTF-8 bytes, which matches Python's code point ordering
+        i = bisect.bisect_left(self, title)
+        if i < len(self) and self[i] == title:
+            return self._order[i].as_py()
+        return None
+
 # ------------------- Main Flow -------------------
 
+async def generate_demo_contradictions(sentence):
+    # Both strategies run in one event loop, so the shared client's connection pool stays valid
+    [contradiction_l1], [contradiction_l2_sourced] = await asyncio.gather(
+        batch_contradict([sentence], level=1),
+        batch_contradict([sentence], level=2, add_fake_source=True)
+    )
+    return contradiction_l1, contradiction_l2_sourced
+
 if __name__ == "__main__":
     # Download the NLTK sentence tokenizer model if not already present
+    # (NLTK >= 3.9 loads Punkt from the pickle-free 'punkt_tab' data and raises LookupError when it is missing)
     try:
-        nltk.data.find('tokenizers/punkt')
-    except nltk.downloader.DownloadError:
-        print("Downloading NLTK's 'punkt' model for sentence tokenization...")
-        nltk.download('punkt')
+        nltk.data.find('tokenizers/punkt_tab/english/')
+    except LookupError:
+        print("Downloading NLTK's 'punkt_tab' model for sentence tokenization...")
+        nltk.download('punkt_tab')
 
     # Load data
     print("Loading Wikipedia corpus...")
@@ -134,13 +219,12 @@ if __name__ == "__main__":
     standard_test_set = pd.read_json(STANDARD_TEST_SET_FILE, lines=True)
 
     # --- IMPROVEMENT 2: EFFICIENT ARTICLE LOOKUP ---
-    # Build a title-to-article index once for instantaneous lookups.
-    print("Building a title-to-article index for fast lookups...")
-    title_to_article_map = {item['title']: item for item in tqdm(wiki_corpus, desc="Indexing articles")}
+    # OPTIMIZATION: Sort the Arrow title column once and binary-search it, instead of
+    # materializing a dict for every article; articles are fetched lazily by row.
+    print("Building a sorted title index for fast lookups...")
+    title_index = TitleIndex(wiki_corpus.data.column('title'))
     print("Index built.")
 
-    agent = ContradictionAgent()
-    
     # Demonstrate by generating contradictions for the first test sample
     sample = standard_test_set.iloc[0]
     supporting_titles = sample['supporting_facts_titles']
@@ -149,7 +233,8 @@ if __name__ == "__main__":
     
     title = supporting_titles[0]
     # Use the fast index instead of the slow .filter() method
-    article = title_to_article_map.get(title)
+    row = title_index.get(title)
+    article = wiki_corpus[row] if row is not None else None
     
     if article:
         original_sentence = find_meaningful_sentence(article)
@@ -157,14 +242,14 @@ if __name__ == "__main__":
         if original_sentence:
             print(f"Original Sentence: {original_sentence}")
 
-            # Generate Level 1 contradiction
+            # Generate the Level 1 contradiction and the Level 2 contradiction with a
+            # fake source (in one API call) concurrently
+            contradiction_l1, contradiction_l2_sourced = asyncio.run(generate_demo_contradictions(original_sentence))
+
             print("\n[Strategy B1: Direct Contradiction]")
-            contradiction_l1 = agent.create_contradiction(original_sentence, level=1)
             print(f"Poisoned L1: {contradiction_l1}")
 
-            # Generate Level 2 contradiction with a fake source (in one API call)
             print("\n[Strategy B2: Indirect Contradiction with Fake Source]")
-            contradiction_l2_sourced = agent.create_contradiction(original_sentence, level=2, add_fake_source=True)
             print(f"Poisoned L2: {contradiction_l2_sourced}")
         else:
             print(f"Could not find a suitable sentence in the article '{title}'.")